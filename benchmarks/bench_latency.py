@@ -0,0 +1,89 @@
+"""
+Throughput and latency benchmark for the Sentinel-2 stages.
+
+Every request recomputes all the dates of the folder (skip_existing=False):
+otherwise the requests after the first one find the products and do nothing.
+
+Fires concurrent requests at a stage endpoint while probing a cheap endpoint
+(/config) to measure how responsive the event loop stays. Run it against the
+server before and after changing VHR_EXECUTOR / VHR_EXECUTOR_WORKERS.
+
+Example:
+    python benchmarks/bench_latency.py --url http://127.0.0.1:8000 \\
+        --endpoint /sentinel2/sr_s2 --folder /usr/src/app/public/output/tmpabcd \\
+        --concurrency 4 --requests 16
+"""
+import time
+import argparse
+import threading
+import numpy as np
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0}
+    values = np.asarray(values) * 1000
+    return {
+        "n": len(values),
+        "p50_ms": round(float(np.percentile(values, 50)), 1),
+        "p90_ms": round(float(np.percentile(values, 90)), 1),
+        "p99_ms": round(float(np.percentile(values, 99)), 1),
+        "max_ms": round(float(values.max()), 1),
+    }
+
+
+def timed_post(url, payload):
+    start = time.perf_counter()
+    response = requests.post(url, json=payload, timeout=3600)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def probe(url, stop, latencies, interval):
+    while not stop.is_set():
+        start = time.perf_counter()
+        requests.get(url, timeout=60)
+        latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--endpoint", default="/sentinel2/sr_s2")
+    parser.add_argument("--folder", required=True, help="Folder with the products of a previous download")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    probe_latencies = []
+    prober = threading.Thread(
+        target=probe, args=(f"{args.url}/config", stop, probe_latencies, args.probe_interval), daemon=True
+    )
+    prober.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(timed_post, f"{args.url}{args.endpoint}", {"folder": args.folder, "skip_existing": False})
+            for _ in range(args.requests)
+        ]
+        stage_latencies = [f.result() for f in futures]
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    prober.join()
+
+    print(f"endpoint:    {args.endpoint}")
+    print(f"throughput:  {args.requests / elapsed:.3f} req/s ({args.requests} requests in {elapsed:.1f}s)")
+    print(f"stage:       {percentiles(stage_latencies)}")
+    print(f"/config:     {percentiles(probe_latencies)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Peak RSS of the SR, buildings and vis stages with the .npy products read
+memory-mapped (VHR_MMAP=1) or fully loaded (VHR_MMAP=0).
+
+Each mode runs in a fresh process over a copy of the same synthetic folder
+(random S2 scenes), and reports the peak RSS over the RSS at the start of
+each stage (see src/memory.py).
+
+Example:
+    cd src && python ../benchmarks/bench_memory.py --edge-size 256 --dates 8 --random
+"""
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def run(mmap, folder, random_weights, results):
+    # Read by raster_io when it is imported
+    os.environ["VHR_MMAP"] = "1" if mmap else "0"
+    import memory
+    import methods
+
+    if random_weights:
+        from super_image import HanConfig, HanModel
+        from segmentation_models_pytorch import Unet
+        sr_model = HanModel(HanConfig(scale=4)).eval()
+        build_model = Unet(encoder_name="mit_b1", in_channels=3, classes=1, encoder_weights=None).eval()
+    else:
+        sr_model, build_model = methods.load_model_sr(), methods.load_model_build()
+
+    methods.sr_folder(folder, sr_model)
+    methods.buildings_folder(folder, build_model)
+    methods.vis_folder(folder)
+    results.put({name: stage["last"] for name, stage in memory.stats()["stages"].items()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--edge-size", type=int, default=256)
+    parser.add_argument("--dates", type=int, default=8)
+    parser.add_argument("--random", action="store_true", help="Use random weights")
+    args = parser.parse_args()
+
+    import numpy as np
+    from raster_io import write_metadata, write_product
+
+    source = tempfile.mkdtemp()
+    write_metadata(source, format="npy", bbox=[0, 0, args.edge_size * 10, args.edge_size * 10], epsg=32630, resolution=10)
+    rng = np.random.default_rng(0)
+    for i in range(args.dates):
+        scene = rng.integers(0, 3000, size=(4, args.edge_size, args.edge_size)).astype(np.float32)
+        write_product(source, "image", f"2024-01-{i + 1:02d}", scene)
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"edge_size={args.edge_size} dates={args.dates}")
+    print(f"{'mode':>6} {'stage':>10} {'peak_MB':>8} {'delta_MB':>9} {'seconds':>8} {'exact':>6}")
+    for mmap in (False, True):
+        folder = tempfile.mkdtemp()
+        shutil.copytree(source, folder, dirs_exist_ok=True)
+        results = ctx.Queue()
+        process = ctx.Process(target=run, args=(mmap, folder, args.random, results))
+        process.start()
+        stages = results.get()
+        process.join()
+        shutil.rmtree(folder, ignore_errors=True)
+        for name, record in stages.items():
+            print(
+                f"{'mmap' if mmap else 'load':>6} {name:>10} {record['peak_rss'] / 1024 ** 2:>8.0f} "
+                f"{record['peak_delta'] / 1024 ** 2:>9.0f} {record['seconds']:>8.2f} {str(record['exact']):>6}"
+            )
+    shutil.rmtree(source, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+CPU throughput of the batched super-resolution for batch sizes 1..N.
+
+Uses the HAN weights in weights/han when they are available (run from src/),
+or a randomly initialized HAN x4 with --random.
+
+Example:
+    cd src && python ../benchmarks/bench_sr_batch.py --edge-size 128 --max-batch 8
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def load_model(random_weights):
+    if random_weights:
+        from super_image import HanConfig, HanModel
+        return HanModel(HanConfig(scale=4)).eval()
+    import methods
+    return methods.load_model_sr()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--edge-size", type=int, default=128)
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--images", type=int, default=16, help="Images processed per batch size")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--random", action="store_true", help="Use random weights")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    import methods
+    model = load_model(args.random)
+    rng = np.random.default_rng(0)
+    images = [
+        rng.integers(0, 3000, size=(4, args.edge_size, args.edge_size)).astype(np.float32)
+        for _ in range(args.images)
+    ]
+
+    # Warm up
+    methods.super_resolve_batch(model, images[:1], max_batch=1)
+
+    print(f"edge_size={args.edge_size} images={args.images} threads={torch.get_num_threads()}")
+    print(f"{'batch':>5} {'seconds':>9} {'images/s':>9}")
+    for batch_size in range(1, args.max_batch + 1):
+        start = time.perf_counter()
+        methods.super_resolve_batch(model, images, max_batch=batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{batch_size:>5} {elapsed:>9.2f} {args.images / elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+SR throughput for different worker x thread configurations.
+
+Each configuration WxT starts W processes (like gunicorn workers) with T
+intra-op threads each, all running super-resolution at the same time, and
+reports the total images/s. Compare e.g. 5x<all cores> (the old default,
+oversubscribed) against the budget of src/threads.py.
+
+Example:
+    cd src && python ../benchmarks/bench_threads.py --configs 1x8,2x4,4x2,8x1,5x8 --random
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def worker(threads, edge_size, images, random_weights, start_event, results):
+    # The thread variables must be set before numpy/torch are imported
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    import numpy as np
+    import torch
+
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    import methods
+    if random_weights:
+        from super_image import HanConfig, HanModel
+        model = HanModel(HanConfig(scale=4)).eval()
+    else:
+        model = methods.load_model_sr()
+
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 3000, size=(4, edge_size, edge_size)).astype(np.float32)
+    methods.super_resolve(model, data)  # warm up
+
+    start_event.wait()
+    start = time.perf_counter()
+    for _ in range(images):
+        methods.super_resolve(model, data)
+    results.put(time.perf_counter() - start)
+
+
+def run(workers, threads, args):
+    ctx = multiprocessing.get_context("spawn")
+    start_event, results = ctx.Event(), ctx.Queue()
+    processes = [
+        ctx.Process(target=worker, args=(threads, args.edge_size, args.images, args.random, start_event, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    time.sleep(args.warmup)
+    start = time.perf_counter()
+    start_event.set()
+    elapsed = [results.get() for _ in processes]
+    wall = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return workers * args.images / wall, max(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--configs", default="1x8,2x4,4x2,8x1")
+    parser.add_argument("--edge-size", type=int, default=64)
+    parser.add_argument("--images", type=int, default=8, help="Images per worker")
+    parser.add_argument("--warmup", type=float, default=20.0, help="Seconds to wait for the models to load")
+    parser.add_argument("--random", action="store_true", help="Use random weights")
+    args = parser.parse_args()
+
+    print(f"cores={os.cpu_count()} edge_size={args.edge_size} images/worker={args.images}")
+    print(f"{'config':>8} {'images/s':>9} {'slowest_s':>9}")
+    for config in args.configs.split(","):
+        workers, threads = (int(v) for v in config.lower().split("x"))
+        throughput, slowest = run(workers, threads, args)
+        print(f"{config:>8} {throughput:>9.2f} {slowest:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
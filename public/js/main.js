@@ -1,4 +1,4 @@
-import { get_query, displayQueryResults, order_download } from './services.js';
+import { get_query, displayQueryResults, order_download, tile_url } from './services.js';
 //////////////////////////////////////////////////////////////////////
 // CHANGE SECTION
 document.getElementById('toDownloadOrder').addEventListener('click', function() {
@@ -83,6 +83,17 @@ function updateLayerList() {
   });
 }
 
+// Overlay a processed product (s2, sr or build) of a job, rendered on demand as tiles
+function addResultLayer(job, product, date) {
+  const layer = new ol.layer.Tile({
+    source: new ol.source.XYZ({ url: tile_url(job, product, date), crossOrigin: 'anonymous' })
+  });
+  layer.set('name', `${product} ${date}`);
+  map.addLayer(layer);
+  return layer;
+}
+window.addResultLayer = addResultLayer;
+
 // Listen for changes to the layer collection and update the layer list
 map.getLayers().on(['add', 'remove'], updateLayerList);
 
@@ -6,7 +6,7 @@ const host = "http://0.0.0.0:8000";
 // Async functions to call the API
 //////////////////////////////////////////////////////////////////////
 
-const get_query = async function (apiKey, geometry, itemName, startDate, endDate,  cloudCover, selectedAsset){
+const get_query = async function (apiKey, geometry, itemName, startDate, endDate,  cloudCover, selectedAsset, onPage = null){
   let coordinates;
   coordinates = valid_geometry(geometry);
   // Crear la URL con todos los parámetros necesarios
@@ -34,7 +34,27 @@ const get_query = async function (apiKey, geometry, itemName, startDate, endDate
         throw new Error(`Error: ${response.status} - ${await response.text()}`);
     }
 
-    const data = await response.json();
+    // NDJSON: one page of items per line, merged as the pages arrive
+    const data = {};
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    const addLine = (line) => {
+      if (!line.trim()) return;
+      const page = JSON.parse(line);
+      if (page.error) throw new Error(page.error);
+      Object.assign(data, page.items);
+      if (onPage) onPage(page.items, data);
+    };
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split('\n');
+      buffer = lines.pop();
+      lines.forEach(addLine);
+    }
+    addLine(buffer + decoder.decode());
     return data;
 } catch (error) {
     console.error('Error al realizar la descarga:', error);
@@ -181,11 +201,31 @@ const order_download = async function (apiKey, itemName, itemList, geometry, Sav
           throw new Error(`Error: ${response2.status} - ${await response2.text()}`);
       }
 
-      const data2 = await response2.json();
-      return data2
+      // The order runs as a job: poll it until the files are downloaded
+      const job = await response2.json();
+      while (true) {
+        await new Promise(resolve => setTimeout(resolve, 5000));
+        const status = await fetch(`${host}/sentinel2/jobs/${job.job_id}`);
+        if (!status.ok) {
+            throw new Error(`Error: ${status.status} - ${await status.text()}`);
+        }
+        const state = await status.json();
+        if (state.status === 'failed') {
+            throw new Error(state.error);
+        }
+        if (state.status === 'done') {
+            const result = await fetch(`${host}/sentinel2/jobs/${job.job_id}/result`);
+            return await result.json();
+        }
+      }
   } catch (error) {
       console.error('Error al realizar la descarga:', error);
   }
   };
 
-export {get_query, displayQueryResults, order_download};
\ No newline at end of file
+// URL template of the XYZ tiles of a processed product (s2, sr or build)
+const tile_url = function(job, product, date) {
+  return `${host}/tiles/${job}/${product}/${date}/{z}/{x}/{y}.png`;
+};
+
+export {get_query, displayQueryResults, order_download, tile_url};
\ No newline at end of file
@@ -0,0 +1,369 @@
+import os
+import time
+import fcntl
+import shutil
+import socket
+import asyncio
+import logging
+import sqlite3
+import contextlib
+
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set
+
+import jobs
+from raster_io import OUTPUT_DIR
+
+logger = logging.getLogger(__name__)
+
+ARTIFACTS_DB = os.getenv("VHR_ARTIFACTS_DB", "/usr/src/app/data/artifacts.sqlite")
+# Byte quota of the output folders, enforced by LRU eviction
+OUTPUT_QUOTA_BYTES = int(os.getenv("VHR_OUTPUT_QUOTA_BYTES", str(20 * 1024 ** 3)))
+# Folders used more recently than this are never evicted (jobs being set up)
+OUTPUT_MIN_AGE = float(os.getenv("VHR_OUTPUT_MIN_AGE", "900"))
+OUTPUT_CLEANUP_INTERVAL = float(os.getenv("VHR_OUTPUT_CLEANUP_INTERVAL", "600"))
+# Accesses of a folder closer than this are recorded once
+TOUCH_INTERVAL = 60.0
+# Folders being evicted are renamed to this prefix, then deleted
+TRASH_PREFIX = ".evicting-"
+
+
+def folder_size(folder: str) -> int:
+    """Total size of the files of a folder, in bytes."""
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def _holder_alive(holder: str) -> bool:
+    # Holds of other hosts can not be checked and are kept
+    host, _, pid = holder.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ArtifactStore:
+    """
+    Index of the output folders (jobs and AOI workspaces) with their size and
+    last access, shared by the gunicorn workers through SQLite.
+
+    When the folders go over the byte quota, the least recently used ones are
+    deleted, except the pinned ones, the ones in use (held by a request or a
+    queued/running job) and the ones used in the last OUTPUT_MIN_AGE seconds.
+    """
+
+    def __init__(
+        self,
+        root: str = OUTPUT_DIR,
+        path: str = ARTIFACTS_DB,
+        quota_bytes: int = OUTPUT_QUOTA_BYTES,
+        min_age: float = OUTPUT_MIN_AGE,
+    ):
+        self.root = os.path.abspath(root)
+        self.path = path
+        self.quota_bytes = quota_bytes
+        self.min_age = min_age
+        self._touched: Dict[str, float] = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS folders (
+                    folder TEXT PRIMARY KEY,
+                    bytes INTEGER NOT NULL DEFAULT 0,
+                    pinned INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS folders_access ON folders (last_access)")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS holds (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    folder TEXT NOT NULL,
+                    holder TEXT NOT NULL,
+                    since REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _managed(self, folder: str) -> Optional[str]:
+        # Only the folders directly under the root are managed
+        folder = os.path.abspath(folder)
+        return folder if os.path.dirname(folder) == self.root else None
+
+    def register(self, folder: str) -> None:
+        """Add a new output folder to the index."""
+        folder = self._managed(folder)
+        if folder is None:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO folders (folder, created, last_access) VALUES (?, ?, ?)",
+                (folder, now, now),
+            )
+
+    def touch(self, folder: str, force: bool = False) -> None:
+        """Record an access to a folder (at most once per TOUCH_INTERVAL per worker)."""
+        folder = self._managed(folder)
+        if folder is None:
+            return
+        now = time.time()
+        if not force and now - self._touched.get(folder, 0) < TOUCH_INTERVAL:
+            return
+        self._touched[folder] = now
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO folders (folder, created, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT(folder) DO UPDATE SET last_access = excluded.last_access",
+                (folder, now, now),
+            )
+
+    def pin(self, folder: str, pinned: bool = True) -> bool:
+        """
+        Protect a folder from eviction, or release it.
+
+        Returns:
+        - bool: False if the folder is not in the index.
+        """
+        folder = self._managed(folder)
+        if folder is None:
+            return False
+        with self._connect() as conn:
+            cursor = conn.execute("UPDATE folders SET pinned = ? WHERE folder = ?", (int(pinned), folder))
+            return cursor.rowcount > 0
+
+    def _acquire(self, folder: str) -> int:
+        # The hold and a fresh last_access in one transaction: a folder becomes
+        # in use and recent at once for evict
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            hold_id = conn.execute(
+                "INSERT INTO holds (folder, holder, since) VALUES (?, ?, ?)",
+                (folder, jobs.worker_id(), now),
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO folders (folder, created, last_access) VALUES (?, ?, ?) "
+                "ON CONFLICT(folder) DO UPDATE SET last_access = excluded.last_access",
+                (folder, now, now),
+            )
+            conn.execute("COMMIT")
+        return hold_id
+
+    def _release(self, folder: str, hold_id: int) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM holds WHERE id = ?", (hold_id,))
+        self.touch(folder, force=True)
+
+    @contextlib.contextmanager
+    def hold(self, folder: str) -> Iterator[None]:
+        """Keep a folder from being evicted while it is in use."""
+        managed = self._managed(folder)
+        if managed is None:
+            yield
+            return
+        hold_id = self._acquire(managed)
+        try:
+            yield
+        finally:
+            self._release(managed, hold_id)
+
+    @contextlib.asynccontextmanager
+    async def ahold(self, folder: str) -> AsyncIterator[None]:
+        """hold for the async handlers: the SQLite writes run in a thread."""
+        managed = self._managed(folder)
+        if managed is None:
+            yield
+            return
+        hold_id = await asyncio.to_thread(self._acquire, managed)
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self._release, managed, hold_id)
+
+    def in_use(self) -> Set[str]:
+        """
+        Folders held by a live worker or used by a queued or running job.
+        The holds of dead workers are dropped.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT id, folder, holder FROM holds").fetchall()
+            stale = [row["id"] for row in rows if not _holder_alive(row["holder"])]
+            conn.executemany("DELETE FROM holds WHERE id = ?", [(i,) for i in stale])
+        folders = {row["folder"] for row in rows if row["id"] not in stale}
+        folders |= {os.path.abspath(f) for f in jobs.get_store().active_folders()}
+        return folders
+
+    def scan(self) -> None:
+        """Index the folders on disk that are not indexed, drop the ones that are gone and update the sizes."""
+        on_disk = {
+            entry.path for entry in os.scandir(self.root)
+            if entry.is_dir(follow_symlinks=False) and not entry.name.startswith(TRASH_PREFIX)
+        } if os.path.isdir(self.root) else set()
+        now = time.time()
+        with self._connect() as conn:
+            indexed = {row["folder"] for row in conn.execute("SELECT folder FROM folders")}
+            conn.executemany("DELETE FROM folders WHERE folder = ?", [(f,) for f in indexed - on_disk])
+            for folder in on_disk:
+                # Unknown folders (e.g. from before the index) count as accessed at their mtime
+                mtime = os.path.getmtime(folder) if folder not in indexed else now
+                conn.execute(
+                    "INSERT INTO folders (folder, bytes, created, last_access) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(folder) DO UPDATE SET bytes = excluded.bytes",
+                    (folder, folder_size(folder), mtime, mtime),
+                )
+
+    def _claim(self, folder: str, cutoff: float, trash: str) -> bool:
+        # Check the folder again and move it out of the way in one write
+        # transaction: a hold taken after the in_use() snapshot either commits
+        # first (and is seen here) or waits until the folder is gone
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT pinned, last_access FROM folders WHERE folder = ?", (folder,)
+                ).fetchone()
+                holders = [r["holder"] for r in conn.execute("SELECT holder FROM holds WHERE folder = ?", (folder,))]
+                if (
+                    row is None
+                    or row["pinned"]
+                    or row["last_access"] >= cutoff
+                    or any(_holder_alive(h) for h in holders)
+                    or folder in {os.path.abspath(f) for f in jobs.get_store().active_folders()}
+                ):
+                    conn.execute("ROLLBACK")
+                    return False
+                os.rename(folder, trash)
+                conn.execute("DELETE FROM folders WHERE folder = ?", (folder,))
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES ('evictions', 1) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+                )
+                conn.execute("COMMIT")
+                return True
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def evict(self) -> List[str]:
+        """
+        Delete the least recently used folders until the total is under the
+        quota. Only one worker evicts at a time.
+
+        Each folder is checked again right before it is deleted (see _claim),
+        so a folder held or used after the candidates were listed is kept.
+
+        Returns:
+        - List[str]: The deleted folders.
+        """
+        with open(f"{self.path}.lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return []
+            # Left by an eviction that was interrupted
+            for entry in os.scandir(self.root) if os.path.isdir(self.root) else []:
+                if entry.name.startswith(TRASH_PREFIX):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            self.scan()
+            in_use = self.in_use()
+            cutoff = time.time() - self.min_age
+            with self._connect() as conn:
+                total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM folders").fetchone()[0]
+                if total <= self.quota_bytes:
+                    return []
+                candidates = conn.execute(
+                    "SELECT folder, bytes FROM folders WHERE pinned = 0 AND last_access < ? ORDER BY last_access",
+                    (cutoff,),
+                ).fetchall()
+
+            evicted = []
+            for row in candidates:
+                if total <= self.quota_bytes:
+                    break
+                if row["folder"] in in_use:
+                    continue
+                trash = os.path.join(self.root, f"{TRASH_PREFIX}{os.path.basename(row['folder'])}.{os.getpid()}")
+                try:
+                    if not self._claim(row["folder"], cutoff, trash):
+                        continue
+                except FileNotFoundError:
+                    continue
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= row["bytes"]
+                evicted.append(row["folder"])
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} output folders, {total} bytes in use")
+        return evicted
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Usage of the output folders.
+
+        Returns:
+        - Dict[str, Any]: Folders, bytes, quota, pinned and in use folders,
+          evictions so far and the largest folders.
+        """
+        in_use = self.in_use()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) AS folders, COALESCE(SUM(bytes), 0) AS bytes, "
+                "COALESCE(SUM(pinned), 0) AS pinned FROM folders"
+            ).fetchone()
+            largest = conn.execute(
+                "SELECT folder, bytes, pinned, last_access FROM folders ORDER BY bytes DESC LIMIT 10"
+            ).fetchall()
+            evictions = conn.execute("SELECT value FROM counters WHERE name = 'evictions'").fetchone()
+        return {
+            "root": self.root,
+            "folders": row["folders"],
+            "bytes": row["bytes"],
+            "quota_bytes": self.quota_bytes,
+            "pinned": row["pinned"],
+            "in_use": len(in_use),
+            "evictions": evictions[0] if evictions else 0,
+            "largest": [dict(r) for r in largest],
+        }
+
+
+async def cleanup_loop(store: "ArtifactStore", interval: float = OUTPUT_CLEANUP_INTERVAL) -> None:
+    """Enforce the quota periodically, in the background of a worker."""
+    while True:
+        try:
+            await asyncio.to_thread(store.evict)
+        except Exception as e:
+            logger.error(f"Error cleaning the output folders: {e}", exc_info=True)
+        await asyncio.sleep(interval)
+
+
+_store: Optional[ArtifactStore] = None
+
+
+def get_store() -> ArtifactStore:
+    """Get the artifact store of this worker, opening it the first time."""
+    global _store
+    if _store is None:
+        _store = ArtifactStore()
+    return _store
@@ -0,0 +1,267 @@
+import os
+import fcntl
+import logging
+import contextlib
+import numpy as np
+import torch
+
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+WEIGHTS_DIR = os.getenv("VHR_WEIGHTS_DIR", "weights")
+
+# Inference backends:
+# - eager: the PyTorch model as loaded (fp32).
+# - torchscript: traced TorchScript module.
+# - onnx: ONNX Runtime, fp32.
+# - onnx-int8: ONNX Runtime with dynamic int8 quantization (the convolutions
+#   and the matrix products).
+# - onnx-int8-static: ONNX Runtime with static int8 (QDQ) quantization,
+#   calibrated with real inputs. Exported offline by export_models.py.
+BACKENDS = ["eager", "torchscript", "onnx", "onnx-int8", "onnx-int8-static"]
+
+ARTIFACT_EXTENSIONS = {
+    "torchscript": "ts.pt",
+    "onnx": "onnx",
+    "onnx-int8": "int8.onnx",
+    "onnx-int8-static": "int8-static.onnx",
+}
+
+
+def artifact_path(name: str, backend: str) -> str:
+    """Path of the cached artifact of a model for a backend, under weights/."""
+    return os.path.join(WEIGHTS_DIR, f"{name}.{ARTIFACT_EXTENSIONS[backend]}")
+
+
+class OnnxModel:
+    """
+    ONNX Runtime session with the call interface of a torch module, so the
+    pipeline can use it as a drop-in replacement: tensor in, tensor out.
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, tensor: torch.Tensor) -> torch.Tensor:
+        array = tensor.detach().cpu().numpy().astype(np.float32, copy=False)
+        output = self.session.run(None, {self.input_name: array})[0]
+        return torch.from_numpy(output)
+
+    def eval(self) -> "OnnxModel":
+        return self
+
+    def cpu(self) -> "OnnxModel":
+        return self
+
+
+@contextlib.contextmanager
+def _export_lock(path: str) -> Iterator[None]:
+    # One export of an artifact at a time across the workers of the host
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_atomic(path: str, write: Callable[[str], None]) -> None:
+    # Readers only ever see a missing or a complete artifact
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _export_onnx(model: torch.nn.Module, example: torch.Tensor, path: str) -> None:
+    torch.onnx.export(
+        model,
+        example,
+        path,
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"}, "output": {0: "batch", 2: "height", 3: "width"}},
+        opset_version=17,
+    )
+
+
+def export(
+    name: str,
+    eager_model: torch.nn.Module,
+    backend: str,
+    example_shape: Sequence[int],
+    calibration: Optional[List[np.ndarray]] = None,
+    overwrite: bool = True,
+) -> str:
+    """
+    Compile a model for a backend and cache the artifact under weights/.
+
+    The artifact is written to a temporary file and renamed, under a file
+    lock, so the workers that start at the same time export it once and never
+    load a partial file.
+
+    Args:
+    - name (str): The artifact name, e.g. 'han_x4'.
+    - eager_model (torch.nn.Module): The fp32 model.
+    - backend (str): One of BACKENDS, except 'eager'.
+    - example_shape (Sequence[int]): Shape of an example input (n, c, h, w).
+    - calibration (List[np.ndarray], optional): Representative inputs, required
+      for 'onnx-int8-static'.
+    - overwrite (bool): Export again if the artifact exists.
+
+    Returns:
+    - str: The path of the artifact.
+
+    Raises:
+    - ValueError: If the backend is unknown, or static quantization has no
+      calibration inputs.
+    """
+    if backend not in ARTIFACT_EXTENSIONS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {BACKENDS}")
+    if backend == "onnx-int8-static" and not calibration:
+        raise ValueError("Static int8 quantization needs representative calibration inputs")
+
+    path = artifact_path(name, backend)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _export_lock(path):
+        if not overwrite and os.path.exists(path):
+            # Exported by another worker while this one waited
+            return path
+
+        example = torch.rand(*example_shape)
+        eager_model = eager_model.cpu().eval()
+        with torch.no_grad():
+            if backend == "torchscript":
+                _write_atomic(path, lambda tmp: torch.jit.save(torch.jit.trace(eager_model, example), tmp))
+            elif backend == "onnx":
+                _write_atomic(path, lambda tmp: _export_onnx(eager_model, example, tmp))
+            else:
+                from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+                fp32_path = artifact_path(name, "onnx")
+                if not os.path.exists(fp32_path):
+                    _write_atomic(fp32_path, lambda tmp: _export_onnx(eager_model, example, tmp))
+
+                if backend == "onnx-int8":
+                    # Dynamic int8 weights of the Conv, MatMul and Gemm nodes
+                    _write_atomic(path, lambda tmp: quantize_dynamic(fp32_path, tmp, weight_type=QuantType.QInt8))
+                else:
+                    _write_atomic(path, lambda tmp: quantize_static(
+                        fp32_path, tmp, _CalibrationReader("input", calibration),
+                        quant_format=QuantFormat.QDQ,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                    ))
+
+    logger.info(f"Exported '{name}' for backend '{backend}' to {path}")
+    return path
+
+
+class _CalibrationReader:
+    """Feeds the calibration inputs to onnxruntime.quantization.quantize_static."""
+
+    def __init__(self, input_name: str, samples: List[np.ndarray]):
+        self._samples = iter([{input_name: s.astype(np.float32, copy=False)} for s in samples])
+
+    def get_next(self):
+        return next(self._samples, None)
+
+    def rewind(self):
+        pass
+
+
+def load_backend(
+    name: str,
+    eager_loader: Callable[[], torch.nn.Module],
+    backend: str,
+    example_shape: Sequence[int],
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Load a model for an inference backend, exporting the artifact the first
+    time it is needed.
+
+    Args:
+    - name (str): The artifact name.
+    - eager_loader (Callable): Loads the fp32 eager model.
+    - backend (str): One of BACKENDS.
+    - example_shape (Sequence[int]): Shape of an example input, for the export.
+
+    Returns:
+    - Callable: A model taking and returning torch tensors.
+    """
+    if backend == "eager":
+        return eager_loader()
+
+    if backend not in ARTIFACT_EXTENSIONS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {BACKENDS}")
+
+    path = artifact_path(name, backend)
+    if not os.path.exists(path):
+        if backend == "onnx-int8-static":
+            # Calibrating on random inputs gives meaningless activation ranges
+            raise FileNotFoundError(
+                f"{path} not found: export it with export_models.py --backend {backend} --calibration-folder <job folder>"
+            )
+        export(name, eager_loader(), backend, example_shape, overwrite=False)
+
+    if backend == "torchscript":
+        return torch.jit.load(path, map_location="cpu").eval()
+    return OnnxModel(path)
+
+
+def psnr(reference: np.ndarray, prediction: np.ndarray, data_range: float = 1.0) -> float:
+    mse = float(np.mean((reference.astype(np.float64) - prediction.astype(np.float64)) ** 2))
+    return float("inf") if mse == 0 else 10 * np.log10(data_range ** 2 / mse)
+
+
+def iou(reference: np.ndarray, prediction: np.ndarray) -> float:
+    reference, prediction = reference.astype(bool), prediction.astype(bool)
+    union = np.logical_or(reference, prediction).sum()
+    return 1.0 if union == 0 else float(np.logical_and(reference, prediction).sum() / union)
+
+
+def check_parity(
+    kind: str,
+    eager_model: Callable,
+    model: Callable,
+    samples: List[np.ndarray],
+    threshold: float = 0.5,
+) -> Dict[str, float]:
+    """
+    Compare a backend against the eager model.
+
+    Args:
+    - kind (str): "sr" (PSNR of the outputs, in dB) or "building" (IoU of
+      the thresholded masks).
+    - eager_model (Callable): The fp32 eager model.
+    - model (Callable): The backend model.
+    - samples (List[np.ndarray]): The inputs (n, c, h, w).
+    - threshold (float): The mask threshold for "building".
+
+    Returns:
+    - Dict[str, float]: The mean, min and per-sample metric.
+    """
+    scores = []
+    with torch.no_grad():
+        for sample in samples:
+            tensor = torch.from_numpy(sample.astype(np.float32, copy=False))
+            reference = eager_model(tensor).numpy()
+            prediction = model(tensor).numpy()
+            if kind == "sr":
+                scores.append(psnr(reference.clip(0, 1), prediction.clip(0, 1)))
+            else:
+                scores.append(iou(reference > threshold, prediction > threshold))
+    metric = "psnr_db" if kind == "sr" else "iou"
+    return {"metric": metric, "mean": float(np.mean(scores)), "min": float(np.min(scores)), "samples": scores}
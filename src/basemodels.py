@@ -1,4 +1,4 @@
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Union
 from pydantic import BaseModel, Field
 
 
@@ -81,6 +81,8 @@ class SearchRequest(BaseModel):
     end_date: str
     cloud_cover: float
     asset: str
+    # Side of the square searched around a point geometry, in 3 m pixels
+    edge_size: int = 256
 
 class DownloadRequest(BaseModel):
     api_key: str
@@ -89,6 +91,7 @@ class DownloadRequest(BaseModel):
     geometry: str
     order_dir: str
     product_bundle: str
+    edge_size: int = 256
 
 # For the FAST API REQUEST
 class SearchRequestS2(BaseModel):
@@ -98,7 +101,39 @@ class SearchRequestS2(BaseModel):
     fechas: str
     edge_size: int
     path: str
+    # Scene selection: "all", "metadata" (eo:cloud_cover) or "scl" (AOI cloud mask)
+    selection: str = "all"
+    max_scenes: int = 1
+    # Storage of the products: "npy" or "cog" (georeferenced, compressed GeoTIFF)
+    output_format: str = "npy"
+
+# For the fused download -> SR -> buildings -> PNG pipeline
+class PipelineRequest(SearchRequestS2):
+    save_intermediates: bool = False
 
 # For the Super resolution
 class SuperResolution(BaseModel):
     folder: str
+    # Keep the products already in the folder (False recomputes every date)
+    skip_existing: bool = True
+
+# For the building footprints
+class FootprintsRequest(BaseModel):
+    folder: str
+    dates: Optional[List[str]] = None
+    simplify: float = 2.5
+    min_area: float = 25.0
+    bbox: Optional[List[float]] = None
+    crs: str = "wgs84"
+    output: str = "geojson"
+
+# For the time-lapse of a processed folder
+class TimelapseRequest(BaseModel):
+    folder: str
+    # "s2", "sr", "build" or "combined"
+    product: str = "sr"
+    # "mp4" or "webp" (animated)
+    output_format: str = "mp4"
+    fps: float = Field(2.0, gt=0)
+    max_size: int = Field(1024, gt=0)
+    dates: Optional[List[str]] = None
@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import sqlite3
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+CACHE_ENABLED = os.getenv("S2_CACHE_ENABLED", "1") == "1"
+CACHE_DIR = os.getenv("S2_CACHE_DIR", "/usr/src/app/data/chips")
+CACHE_MAX_BYTES = int(os.getenv("S2_CACHE_MAX_BYTES", str(5 * 1024 ** 3)))
+# Time a STAC search result is reused before searching again
+CACHE_SEARCH_TTL = float(os.getenv("S2_CACHE_SEARCH_TTL", str(7 * 24 * 3600)))
+# Same for a search whose window is not over yet (new acquisitions can show up)
+CACHE_OPEN_SEARCH_TTL = float(os.getenv("S2_CACHE_OPEN_SEARCH_TTL", "3600"))
+
+
+def make_key(*parts: Any) -> str:
+    """
+    Build a content address from the parts that identify a chip or a search.
+
+    Returns:
+    - str: The sha256 hex digest of the parts.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def chip_key(item_id: str, bbox: Sequence[float], epsg: Any, bands: List[str], resolution: float) -> str:
+    """
+    Key of a chip: STAC item id, snapped UTM bbox, bands and resolution.
+    """
+    return make_key("chip", item_id, [round(float(v), 3) for v in bbox], str(epsg), list(bands), float(resolution))
+
+
+class ChipCache:
+    """
+    Persistent, content-addressed cache of Sentinel-2 chips.
+
+    The chips are stored as compressed .npz files and indexed in SQLite with
+    their size and last access, so the gunicorn workers can share the cache.
+    When the total size goes over max_bytes, the least recently used chips are
+    evicted. The files are written to a temporary name and renamed, so a
+    reader never sees a partial chip.
+    """
+
+    def __init__(self, root: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chips (
+                    key TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    meta TEXT,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chips_access ON chips (last_access)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, entries TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(os.path.join(self.root, "index.sqlite"), timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _count(self, conn: sqlite3.Connection, name: str) -> None:
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, Dict[str, Any]]]:
+        """
+        Get a chip from the cache.
+
+        Args:
+        - key (str): The chip key (see chip_key).
+
+        Returns:
+        - Tuple[np.ndarray, Dict]: The chip and its metadata, or None on a miss.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT path, meta FROM chips WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                try:
+                    with np.load(row["path"]) as data:
+                        array = data["chip"]
+                except (OSError, KeyError, ValueError):
+                    # Evicted by another worker or corrupted: treat as a miss
+                    conn.execute("DELETE FROM chips WHERE key = ?", (key,))
+                    row = None
+            if row is None:
+                self._count(conn, "misses")
+                return None
+            conn.execute("UPDATE chips SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._count(conn, "hits")
+        return array, json.loads(row["meta"] or "{}")
+
+    def put(self, key: str, array: np.ndarray, meta: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Store a chip and evict the least recently used chips over the budget.
+
+        Args:
+        - key (str): The chip key (see chip_key).
+        - array (np.ndarray): The chip.
+        - meta (Dict, optional): JSON serializable metadata of the chip.
+        """
+        path = os.path.join(self.root, key[:2], f"{key}.npz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp.npz"
+        np.savez_compressed(tmp_path, chip=array)
+        os.replace(tmp_path, path)
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chips (key, path, bytes, meta, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, path, os.path.getsize(path), json.dumps(meta or {}), time.time()),
+            )
+        self.evict()
+
+    def evict(self) -> List[str]:
+        """
+        Remove the least recently used chips until the cache fits in max_bytes.
+
+        Returns:
+        - List[str]: The evicted keys.
+        """
+        evicted = []
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM chips").fetchone()[0]
+            if total > self.max_bytes:
+                for row in conn.execute("SELECT key, path, bytes FROM chips ORDER BY last_access").fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(row["path"])
+                    except FileNotFoundError:
+                        pass
+                    conn.execute("DELETE FROM chips WHERE key = ?", (row["key"],))
+                    total -= row["bytes"]
+                    evicted.append(row["key"])
+            for _ in evicted:
+                self._count(conn, "evictions")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return evicted
+
+    def contains(self, key: str) -> bool:
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM chips WHERE key = ?", (key,)).fetchone() is not None
+
+    def get_search(self, key: str, ttl: float = CACHE_SEARCH_TTL) -> Optional[List[Dict[str, Any]]]:
+        """
+        Get the entries (date, item id, chip key) of a previous STAC search.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT entries, created FROM searches WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row["created"] > ttl:
+                return None
+            self._count(conn, "search_hits")
+        return json.loads(row["entries"])
+
+    def put_search(self, key: str, entries: List[Dict[str, Any]]) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO searches (key, entries, created) VALUES (?, ?, ?)",
+                (key, json.dumps(entries), time.time()),
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the usage and the hit/miss counters of the cache.
+        """
+        with self._connect() as conn:
+            entries, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM chips").fetchone()
+            counters = {row["name"]: row["value"] for row in conn.execute("SELECT name, value FROM counters")}
+        return {
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "search_hits": counters.get("search_hits", 0),
+            "evictions": counters.get("evictions", 0),
+        }
+
+
+_cache: Optional[ChipCache] = None
+
+
+def get_cache() -> Optional[ChipCache]:
+    """Get the chip cache of this worker, or None if it is disabled."""
+    global _cache
+    if _cache is None and CACHE_ENABLED:
+        _cache = ChipCache()
+    return _cache
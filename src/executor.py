@@ -0,0 +1,128 @@
+import os
+import asyncio
+import logging
+import threading
+import functools
+import importlib
+import multiprocessing
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Executor used for the CPU-bound stages (SR, buildings, visualization):
+# - "thread": threads in the worker process, sharing the models of the registry.
+#   Torch releases the GIL during the forward pass.
+# - "process": a pool of spawned processes, each one with its own warm models.
+EXECUTOR_KIND = os.getenv("VHR_EXECUTOR", "thread").lower()
+EXECUTOR_WORKERS = int(os.getenv("VHR_EXECUTOR_WORKERS", "2"))
+
+_executor: Optional[Executor] = None
+_recycle_lock = threading.Lock()
+
+
+def _init_process_worker() -> None:
+    """Warm the models of a process of the pool once, when it is spawned."""
+    # The thread variables are inherited from the worker, set torch before loading
+    import threads
+    threads.apply_runtime()
+    # Importing methods registers the model loaders in this process registry
+    importlib.import_module("methods")
+    from model_registry import registry
+    registry.load_all()
+
+
+def shares_models() -> bool:
+    """
+    Check if the tasks run in this process and can use its loaded models.
+
+    Returns:
+    - bool: True for the thread executor, False for the process pool.
+    """
+    return EXECUTOR_KIND != "process"
+
+
+def _create_executor() -> Executor:
+    if EXECUTOR_KIND == "process":
+        return ProcessPoolExecutor(
+            max_workers=EXECUTOR_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process_worker,
+        )
+    if EXECUTOR_KIND == "thread":
+        return ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="vhr-stage")
+    raise ValueError(f"Unknown executor '{EXECUTOR_KIND}', use 'thread' or 'process'")
+
+
+def get_executor() -> Executor:
+    """
+    Get the executor of this worker, creating it the first time.
+
+    Returns:
+    - Executor: The thread or process pool executor.
+    """
+    global _executor
+    if _executor is None:
+        _executor = _create_executor()
+        logger.info(f"Executor '{EXECUTOR_KIND}' started with {EXECUTOR_WORKERS} workers")
+    return _executor
+
+
+async def run(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a blocking function in the executor without blocking the event loop.
+
+    Args:
+    - func (Callable): The function to run. It must be importable (picklable)
+      when the process executor is used.
+    - *args, **kwargs: The arguments of the function.
+
+    Returns:
+    - Any: The result of the function.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def _warm(executor: Executor) -> None:
+    if isinstance(executor, ProcessPoolExecutor):
+        futures = [executor.submit(os.getpid) for _ in range(EXECUTOR_WORKERS)]
+        for future in futures:
+            future.result()
+
+
+def warm_up() -> None:
+    """Start the executor and, for the process pool, spawn and warm all its processes."""
+    _warm(get_executor())
+
+
+def recycle() -> None:
+    """
+    Replace the process pool by a new one, whose processes load the models
+    from disk again. The tasks already submitted finish in the old pool, and
+    if the new processes fail to load the models the old pool keeps serving.
+    Nothing to do for the thread executor, which uses the worker registry.
+    """
+    global _executor
+    if shares_models():
+        return
+    with _recycle_lock:
+        new = _create_executor()
+        try:
+            _warm(new)
+        except Exception:
+            new.shutdown(wait=False, cancel_futures=True)
+            raise
+        old, _executor = _executor, new
+        if old is not None:
+            old.shutdown(wait=False)
+    logger.info("Process pool recycled with freshly loaded models")
+
+
+def shutdown() -> None:
+    """Stop the executor of this worker."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
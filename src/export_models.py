@@ -0,0 +1,100 @@
+"""
+Export the SR and building models to an inference backend, cache the
+artifact under weights/ and check its accuracy and latency against the
+eager model (PSNR for SR, IoU for building masks).
+
+Example (from src/):
+    python export_models.py --model sr --backend onnx-int8 --force
+    python export_models.py --model building --backend onnx-int8-static \\
+        --calibration-folder /usr/src/app/public/output/tmpabcd
+"""
+import time
+import argparse
+import numpy as np
+import torch
+
+import backends
+import methods
+from raster_io import list_products, read_product
+
+SR_INPUT = 96
+BUILD_INPUT = 256
+
+
+def crops(array: np.ndarray, size: int, count: int, rng: np.random.Generator) -> list:
+    _, height, width = array.shape
+    samples = []
+    for _ in range(count):
+        y = rng.integers(0, max(1, height - size + 1))
+        x = rng.integers(0, max(1, width - size + 1))
+        samples.append(array[None, :, y:y + size, x:x + size].astype(np.float32))
+    return samples
+
+
+def load_samples(kind: str, folder: str, count: int, rng: np.random.Generator) -> list:
+    """
+    Representative inputs: crops of the stored products of a job folder (S2
+    scenes for SR, normalized SR images for buildings), or random inputs
+    without a folder (only good enough for the parity and latency checks).
+    """
+    size = SR_INPUT if kind == "sr" else BUILD_INPUT
+    if folder:
+        samples = []
+        if kind == "sr":
+            for path in list_products(folder, "image"):
+                samples += crops(read_product(path)[0:3] / 10000, size, count, rng)
+        else:
+            mean = np.asarray(methods.BUILD_MEAN, dtype=np.float32)[:, None, None]
+            std = np.asarray(methods.BUILD_STD, dtype=np.float32)[:, None, None]
+            for path in list_products(folder, "sr"):
+                samples += crops((read_product(path) - mean) / std, size, count, rng)
+        if samples:
+            return samples[:count]
+    return [rng.random((1, 3, size, size), dtype=np.float32) * 0.3 for _ in range(count)]
+
+
+def latency(model, samples) -> float:
+    with torch.no_grad():
+        model(torch.from_numpy(samples[0]))
+        start = time.perf_counter()
+        for sample in samples:
+            model(torch.from_numpy(sample))
+    return (time.perf_counter() - start) / len(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", choices=["sr", "building"], required=True)
+    parser.add_argument("--backend", choices=[b for b in backends.BACKENDS if b != "eager"], required=True)
+    parser.add_argument("--calibration-folder", default=None, help="Job folder with image_/sr_ products")
+    parser.add_argument("--samples", type=int, default=8)
+    parser.add_argument("--force", action="store_true", help="Export again even if the artifact exists")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    samples = load_samples(args.model, args.calibration_folder, args.samples, rng)
+    calibration = None
+    if args.backend == "onnx-int8-static":
+        if not args.calibration_folder or not list_products(args.calibration_folder, "image" if args.model == "sr" else "sr"):
+            parser.error("onnx-int8-static needs --calibration-folder with the products of a real job")
+        calibration = samples
+
+    if args.model == "sr":
+        name, eager_model, shape = "han_x4", methods.load_model_sr_eager(), (1, 3, SR_INPUT, SR_INPUT)
+        model_loader = methods.load_model_sr
+    else:
+        name, eager_model, shape = "mitb1_building_unet", methods.load_model_build_eager(), (1, 3, BUILD_INPUT, BUILD_INPUT)
+        model_loader = methods.load_model_build
+
+    backends.export(name, eager_model, args.backend, shape, calibration=calibration, overwrite=args.force)
+    model = model_loader(args.backend)
+
+    parity = backends.check_parity(args.model, eager_model, model, samples, threshold=methods.BUILD_THRESHOLD)
+    print(f"artifact: {backends.artifact_path(name, args.backend)}")
+    print(f"{parity['metric']}: mean={parity['mean']:.4f} min={parity['min']:.4f}")
+    print(f"latency eager:   {latency(eager_model, samples):.1f} ms/image")
+    print(f"latency {args.backend}: {latency(model, samples):.1f} ms/image")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import io
+import numpy as np
+
+from typing import Any, Dict, List, Optional, Sequence
+
+from pyproj import Transformer
+from rasterio.features import shapes
+from rasterio.transform import Affine
+from shapely.geometry import box, mapping, shape
+from shapely.ops import transform as shapely_transform
+
+
+def _round_coords(geometry: Dict[str, Any], decimals: int) -> Dict[str, Any]:
+    def round_nested(coords):
+        if isinstance(coords[0], (int, float)):
+            return [round(c, decimals) for c in coords]
+        return [round_nested(c) for c in coords]
+    return {"type": geometry["type"], "coordinates": round_nested(geometry["coordinates"])}
+
+
+def mask_to_features(
+    mask: np.ndarray,
+    transform: Affine,
+    epsg: int,
+    date: str,
+    simplify: float = 2.5,
+    min_area: float = 25.0,
+) -> List[Dict[str, Any]]:
+    """
+    Turn a building mask into simplified polygons.
+
+    Args:
+    - mask (np.ndarray): The (H, W) 0/1 mask.
+    - transform (Affine): The transform of the mask in the scene CRS.
+    - epsg (int): The EPSG code of the scene CRS (UTM).
+    - date (str): The date of the mask, stored as an attribute.
+    - simplify (float): The simplification tolerance, in meters.
+    - min_area (float): Polygons smaller than this (m2) are dropped.
+
+    Returns:
+    - List[Dict]: One dict per building with the scene CRS and WGS84
+      shapely geometries, the area in m2 and the date.
+    """
+    to_wgs84 = Transformer.from_crs(f"EPSG:{epsg}", "EPSG:4326", always_xy=True).transform
+    binary = (mask > 0).astype(np.uint8)
+
+    features = []
+    for geometry, _ in shapes(binary, mask=binary.astype(bool), transform=transform):
+        polygon = shape(geometry)
+        if polygon.area < min_area:
+            continue
+        if simplify > 0:
+            polygon = polygon.simplify(simplify, preserve_topology=True)
+        features.append({
+            "geometry": polygon,
+            "geometry_wgs84": shapely_transform(to_wgs84, polygon),
+            "area_m2": round(polygon.area, 1),
+            "date": date,
+        })
+    return features
+
+
+def filter_bbox(features: List[Dict[str, Any]], bbox: Optional[Sequence[float]]) -> List[Dict[str, Any]]:
+    """Keep the features intersecting a WGS84 bbox [minx, miny, maxx, maxy]."""
+    if not bbox:
+        return features
+    area = box(*bbox)
+    return [f for f in features if f["geometry_wgs84"].intersects(area)]
+
+
+def to_geojson(features: List[Dict[str, Any]], crs: str = "wgs84", epsg: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build a compact GeoJSON FeatureCollection (coordinates rounded to ~1 cm).
+
+    Args:
+    - features (List[Dict]): The features (see mask_to_features).
+    - crs (str): "wgs84" or "scene" (UTM of the scene).
+    - epsg (int, optional): The EPSG code of the scene, for crs="scene".
+
+    Returns:
+    - Dict: The FeatureCollection.
+    """
+    key, decimals = ("geometry_wgs84", 7) if crs == "wgs84" else ("geometry", 2)
+    collection = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "id": i,
+                "geometry": _round_coords(mapping(f[key]), decimals),
+                "properties": {"date": f["date"], "area_m2": f["area_m2"]},
+            }
+            for i, f in enumerate(features)
+        ],
+    }
+    if crs != "wgs84":
+        collection["crs"] = {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{epsg}"}}
+    return collection
+
+
+def to_geoparquet(features: List[Dict[str, Any]], crs: str = "wgs84", epsg: Optional[int] = None) -> bytes:
+    """
+    Encode the features as GeoParquet. Needs geopandas and pyarrow.
+
+    Returns:
+    - bytes: The GeoParquet file.
+    """
+    import geopandas as gpd
+
+    key = "geometry_wgs84" if crs == "wgs84" else "geometry"
+    frame = gpd.GeoDataFrame(
+        {"date": [f["date"] for f in features], "area_m2": [f["area_m2"] for f in features]},
+        geometry=[f[key] for f in features],
+        crs="EPSG:4326" if crs == "wgs84" else f"EPSG:{epsg}",
+    )
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, compression="zstd")
+    return buffer.getvalue()
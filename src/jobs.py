@@ -0,0 +1,402 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import sqlite3
+
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.getenv("VHR_JOBS_DB", "/usr/src/app/data/jobs.sqlite")
+JOB_CONCURRENCY = int(os.getenv("VHR_JOB_CONCURRENCY", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("VHR_JOB_POLL_INTERVAL", "1.0"))
+
+# Stages of the Sentinel-2 pipeline, in order
+STAGES = ["download", "sr", "buildings", "vis"]
+# Kind of the jobs of the Sentinel-2 pipeline (the default)
+SENTINEL2 = "sentinel2"
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    """
+    Persistent job queue backed by a local SQLite database.
+
+    The database is shared by all the gunicorn workers. Jobs are claimed
+    atomically, so every queued job is run by exactly one worker, and the jobs
+    of a worker that died are queued again when the store is opened.
+    """
+
+    def __init__(self, path: str = JOBS_DB):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    stages TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL
+                )
+                """
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            # The runner of each kind of job, and the worker that must run the
+            # job (e.g. the only one with its credentials in memory)
+            if "kind" not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT '{SENTINEL2}'")
+            if "affinity" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN affinity TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            # Progress events of the jobs, read by the SSE stream of any worker
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    event TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS events_job ON events (job_id, id)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["stages"] = json.loads(job["stages"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def submit(
+        self,
+        params: Dict[str, Any],
+        kind: str = SENTINEL2,
+        stages: Optional[List[str]] = None,
+        affinity: Optional[str] = None,
+    ) -> str:
+        """
+        Add a new job to the queue.
+
+        Args:
+        - params (Dict[str, Any]): The parameters of the job.
+        - kind (str): The kind of job, which selects its stages in the runner.
+        - stages (List[str], optional): The stage names. The Sentinel-2 ones by default.
+        - affinity (str, optional): Only this worker (see worker_id) can run the job.
+
+        Returns:
+        - str: The job id.
+        """
+        job_id = uuid.uuid4().hex
+        stages = {stage: {"state": QUEUED} for stage in (stages or STAGES)}
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, stages, created, kind, affinity) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(params), json.dumps(stages), time.time(), kind, affinity),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def claim(self, worker: str) -> Optional[Dict[str, Any]]:
+        """
+        Atomically take the oldest queued job this worker can run.
+
+        Args:
+        - worker (str): The id of the worker claiming the job.
+
+        Returns:
+        - Dict[str, Any]: The claimed job, or None if the queue is empty.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND (affinity IS NULL OR affinity = ?) ORDER BY created LIMIT 1",
+                (QUEUED, worker),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started = COALESCE(started, ?) WHERE id = ?",
+                (RUNNING, worker, time.time(), row["id"]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return self.get(row["id"])
+
+    def update_stage(self, job_id: str, stage: str, **fields) -> None:
+        """Merge the given fields into the state of a stage."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT stages FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            stages = json.loads(row["stages"])
+            stages.setdefault(stage, {}).update(fields)
+            conn.execute("UPDATE jobs SET stages = ? WHERE id = ?", (json.dumps(stages), job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def update_result(self, job_id: str, **fields) -> None:
+        """Merge the given fields into the result of a job."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            result = json.loads(row["result"]) if row["result"] else {}
+            result.update(fields)
+            conn.execute("UPDATE jobs SET result = ? WHERE id = ?", (json.dumps(result), job_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+    def add_event(self, job_id: str, event: str, data: Dict[str, Any]) -> int:
+        """
+        Publish a progress event of a job.
+
+        Returns:
+        - int: The id of the event, increasing for every job.
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO events (job_id, event, data, created) VALUES (?, ?, ?, ?)",
+                (job_id, event, json.dumps(data), time.time()),
+            )
+            return cursor.lastrowid
+
+    def events(self, job_id: str, after: int = 0) -> List[Dict[str, Any]]:
+        """
+        Get the events of a job published after the given event id.
+
+        Returns:
+        - List[Dict[str, Any]]: The events (id, event, data, created), oldest first.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM events WHERE job_id = ? AND id > ? ORDER BY id", (job_id, after)
+            ).fetchall()
+        return [{**dict(row), "data": json.loads(row["data"])} for row in rows]
+
+    def active_folders(self) -> List[str]:
+        """Output folders of the queued and running jobs."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT result FROM jobs WHERE status IN (?, ?) AND result IS NOT NULL", (QUEUED, RUNNING)
+            ).fetchall()
+        folders = [json.loads(row["result"]).get("folder") for row in rows]
+        return [f for f in folders if f]
+
+    def requeue_orphans(self) -> List[str]:
+        """
+        Queue again the running jobs whose worker process is gone on this host.
+        The jobs bound to a gone worker (affinity) can not run anywhere else
+        and fail instead.
+
+        Returns:
+        - List[str]: The ids of the jobs queued again.
+        """
+        host = socket.gethostname()
+
+        def gone(worker: Optional[str]) -> bool:
+            worker_host, _, pid = (worker or "").rpartition(":")
+            return worker_host == host and pid.isdigit() and not _pid_alive(int(pid))
+
+        requeued = []
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, status, worker, affinity FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+            for row in rows:
+                if row["affinity"] and gone(row["affinity"]):
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                        (FAILED, "The worker running the job stopped, submit it again", time.time(), row["id"]),
+                    )
+                elif row["status"] == RUNNING and gone(row["worker"]):
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, worker = NULL WHERE id = ?", (QUEUED, row["id"])
+                    )
+                    requeued.append(row["id"])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        if requeued:
+            logger.info(f"Requeued orphan jobs: {requeued}")
+        return requeued
+
+
+# A stage receives the job parameters and the current result, and returns
+# the fields to merge into the result. A "previews" field ({kind: {date: path}})
+# is published right away as a "preview" event and kept in result["previews"]
+Stage = Callable[[Dict[str, Any], Dict[str, Any]], Awaitable[Dict[str, Any]]]
+
+
+class JobRunner:
+    """
+    Background task of a worker that claims queued jobs and runs their stages.
+
+    Up to `concurrency` jobs run at the same time in each worker, so the jobs
+    are pipelined: while one job is in SR, another one can be downloading.
+    The stages of a job are the ones of its kind.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        pipelines: Dict[str, List[Tuple[str, Stage]]],
+        concurrency: int = JOB_CONCURRENCY,
+    ):
+        self.store = store
+        self.pipelines = pipelines
+        self.concurrency = concurrency
+        self.worker = worker_id()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    async def _write(self, method: Callable[..., Any], *args, **kwargs) -> Any:
+        # The SQLite writes can wait for the lock of other workers, keep them off the event loop
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        result = job["result"] or {}
+        try:
+            if job["kind"] not in self.pipelines:
+                raise ValueError(f"Unknown job kind '{job['kind']}'")
+            for name, stage in self.pipelines[job["kind"]]:
+                # Stages finished before a restart are not repeated
+                if job["stages"].get(name, {}).get("state") == DONE:
+                    continue
+                start = time.time()
+                await self._write(self.store.update_stage, job_id, name, state=RUNNING, started=start)
+                await self._write(self.store.add_event, job_id, "stage", {"stage": name, "state": RUNNING})
+                try:
+                    fields = await stage(job["params"], result) or {}
+                except Exception as e:
+                    await self._write(
+                        self.store.update_stage, job_id, name, state=FAILED, finished=time.time(),
+                        seconds=round(time.time() - start, 3), error=str(e),
+                    )
+                    await self._write(self.store.add_event, job_id, "stage", {"stage": name, "state": FAILED, "error": str(e)})
+                    raise
+                previews = fields.pop("previews", None)
+                if previews:
+                    await self._write(self.store.add_event, job_id, "preview", {"stage": name, "previews": previews})
+                    fields["previews"] = {**result.get("previews", {}), **previews}
+                result.update(fields)
+                await self._write(self.store.update_result, job_id, **fields)
+                seconds = round(time.time() - start, 3)
+                await self._write(self.store.update_stage, job_id, name, state=DONE, finished=time.time(), seconds=seconds)
+                await self._write(
+                    self.store.add_event, job_id, "stage",
+                    {"stage": name, "state": DONE, "seconds": seconds, "result": {k: v for k, v in fields.items() if k != "previews"}},
+                )
+            await self._write(self.store.finish, job_id, DONE)
+            await self._write(self.store.add_event, job_id, "job", {"status": DONE})
+        except Exception as e:
+            logger.error(f"Job {job_id} failed: {e}", exc_info=True)
+            await self._write(self.store.finish, job_id, FAILED, error=str(e))
+            await self._write(self.store.add_event, job_id, "job", {"status": FAILED, "error": str(e)})
+
+    async def _loop(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            await semaphore.acquire()
+            try:
+                job = await asyncio.to_thread(self.store.claim, self.worker)
+            except Exception as e:
+                logger.error(f"Error claiming a job: {e}", exc_info=True)
+                job = None
+            if job is None:
+                semaphore.release()
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+                continue
+
+            task = asyncio.create_task(self._run_job(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+            task.add_done_callback(lambda _: semaphore.release())
+
+    def start(self) -> None:
+        self.store.requeue_orphans()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        tasks = [t for t in [self._task, *self._running] if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+
+_store: Optional[JobStore] = None
+
+
+def get_store() -> JobStore:
+    """Get the job store of this worker, opening it the first time."""
+    global _store
+    if _store is None:
+        _store = JobStore()
+    return _store
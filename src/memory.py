@@ -0,0 +1,96 @@
+import time
+import logging
+import threading
+import contextlib
+
+from typing import Any, Dict, Iterator
+
+logger = logging.getLogger(__name__)
+
+# Peak RSS of the last and worst run of each stage in this process. The peak
+# (VmHWM) is process wide: with several stages running at once the numbers
+# mix, so measure with VHR_EXECUTOR_WORKERS=1 and VHR_JOB_CONCURRENCY=1
+_stages: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def _status_bytes(field: str) -> int:
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def current_rss() -> int:
+    """Resident memory of this process, in bytes (0 if unknown)."""
+    return _status_bytes("VmRSS")
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process (VmHWM), in bytes (0 if unknown)."""
+    return _status_bytes("VmHWM")
+
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak resident memory of this process to the current one.
+
+    Returns:
+    - bool: False if the kernel does not allow it (the peak is then the
+      peak since the process started).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextlib.contextmanager
+def track_peak(stage: str) -> Iterator[Dict[str, Any]]:
+    """
+    Measure the peak RSS of a block and record it for the stage.
+
+    Yields:
+    - Dict[str, Any]: Filled on exit with rss_start, peak_rss, peak_delta
+      (bytes over the RSS at the start), seconds and exact (False if the
+      peak could not be reset).
+    """
+    exact = reset_peak_rss()
+    start = current_rss()
+    tic = time.perf_counter()
+    record: Dict[str, Any] = {}
+    try:
+        yield record
+    finally:
+        peak = peak_rss()
+        record.update(
+            rss_start=start,
+            peak_rss=peak,
+            peak_delta=max(0, peak - start),
+            seconds=round(time.perf_counter() - tic, 3),
+            exact=exact,
+        )
+        with _lock:
+            entry = _stages.setdefault(stage, {"runs": 0, "max_peak_delta": 0})
+            entry["runs"] += 1
+            entry["last"] = dict(record)
+            entry["max_peak_delta"] = max(entry["max_peak_delta"], record["peak_delta"])
+        logger.info(f"Stage {stage}: peak RSS {peak / 1024 ** 2:.0f} MB (+{record['peak_delta'] / 1024 ** 2:.0f} MB)")
+
+
+def stats() -> Dict[str, Any]:
+    """
+    Peak RSS of the stages run in this process.
+
+    Returns:
+    - Dict[str, Any]: The current and peak RSS, and the last and worst peak of each stage.
+    """
+    with _lock:
+        stages = {name: {**entry, "last": dict(entry.get("last", {}))} for name, entry in _stages.items()}
+    return {"rss": current_rss(), "peak_rss": peak_rss(), "stages": stages}
@@ -1,37 +1,68 @@
 import os
-import cubo
+import time
+import fcntl
+import asyncio
 import tempfile
+import contextlib
 import numpy as np
 import xarray as xr
-import matplotlib.pyplot as plt
-
-import nest_asyncio
 
 # import tensorflow as tf
 import rioxarray as rxr
 
-from typing import Dict, List
-from skimage import exposure
-from datetime import datetime
-from datetime import timedelta
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import torch
-from torchvision import transforms
 from super_image import HanModel
 from segmentation_models_pytorch import Unet
 
 from fastapi import HTTPException
 
-nest_asyncio.apply()
+import backends
+import executor
+import artifact_store
+import memory
+from chip_cache import CACHE_OPEN_SEARCH_TTL, CACHE_SEARCH_TTL, chip_key, get_cache, make_key
+from stac_search import (
+    assign_items, item_date, merge_windows, search_items, select_items, stack_items, utm_bbox, window_closed
+)
+from model_registry import registry
+from tiling import tiled_apply
+from render import apply_stretch, composite, compute_stretch, folder_stretch, mask_to_gray, save_image
+from footprints import filter_bbox, mask_to_features, to_geojson, to_geoparquet
+from rasterio.transform import from_bounds
+from raster_io import (
+    OUTPUT_DIR, list_products, product_paths, read_metadata, read_product, register_product, write_metadata, write_product
+)
+
+# Inference backend of each model (see backends.BACKENDS)
+SR_BACKEND = os.getenv("VHR_SR_BACKEND", "eager")
+BUILD_BACKEND = os.getenv("VHR_BUILD_BACKEND", "eager")
 
-def load_model_sr():
+def load_model_sr_eager():
     model = HanModel.from_pretrained('weights/han', scale=4)
+    model.eval()
     return model
 
-def load_model_build():
-    model = torch.load("weights/mitb1_building_unet_best_model.pth", map_location=torch.device("cpu"))
+def load_model_build_eager():
+    checkpoint = torch.load("weights/mitb1_building_unet_best_model.pth", map_location=torch.device("cpu"))
+    model = Unet(encoder_name="mit_b1", in_channels=3, classes=1, encoder_weights=None)  # Set encoder_weights to None
+    model.load_state_dict(checkpoint)
+    model = model.cpu()
+    model.eval()
     return model
 
+def load_model_sr(backend: str = None):
+    return backends.load_backend("han_x4", load_model_sr_eager, backend or SR_BACKEND, (1, 3, 96, 96))
+
+def load_model_build(backend: str = None):
+    return backends.load_backend("mitb1_building_unet", load_model_build_eager, backend or BUILD_BACKEND, (1, 3, 256, 256))
+
+# Models loaded once per worker (see the lifespan hook in server.py)
+registry.register("sr", load_model_sr)
+registry.register("building", load_model_build)
+
 # def load_model_roads():
 #     model = torch.load("weights/mit_b1unet_best_model.pth")
 #     return model
@@ -42,205 +73,1009 @@ async def get_sentinel2(
         bands: List[str],
         fechas: str,
         edge_size: int,
-        path: str
+        path: str,
+        selection: str = "all",
+        max_scenes: int = 1,
+        output_format: str = "npy"
+    ):
+    # Network bound: a thread is enough to keep the event loop free
+    return await asyncio.to_thread(
+        download_sentinel2, lat, lon, bands, fechas, edge_size, path, selection, max_scenes, output_format
+    )
+
+def create_output_folder() -> str:
+    tempfile.tempdir = OUTPUT_DIR
+    folder = tempfile.mkdtemp()
+    artifact_store.get_store().register(folder)
+    return folder
+
+# Number of scenes downloaded at the same time
+S2_DATE_CONCURRENCY = int(os.getenv("S2_DATE_CONCURRENCY", "4"))
+
+def read_scene(cube: xr.DataArray, index: int, key: str, meta: Dict) -> np.ndarray:
+    """
+    Read one scene of the cube, through the chip cache when it is enabled.
+    """
+    cache = get_cache()
+    if cache is not None:
+        chip = cache.get(key)
+        if chip is not None:
+            return chip[0]
+    data = cube[index].to_numpy()
+    if cache is not None:
+        cache.put(key, data, meta)
+    return data
+
+def mosaic_scenes(scenes: List[np.ndarray]) -> np.ndarray:
+    """
+    Merge the scenes of one day: the pixels without data (NaN) of a scene are
+    taken from the next ones, in the given order.
+    """
+    mosaic = scenes[0]
+    for scene in scenes[1:]:
+        missing = np.isnan(mosaic)
+        if not missing.any():
+            break
+        mosaic = np.where(missing, scene, mosaic)
+    return mosaic
+
+def fetch_sentinel2(
+        lat: float,
+        lon: float,
+        bands: List[str],
+        fechas: str,
+        edge_size: int,
+        days_delay: int = 10,
+        selection: str = "all",
+        max_scenes: int = 1
+    ) -> Tuple[Dict[str, np.ndarray], Dict[str, Dict], Dict]:
+    """
+    Download the Sentinel-2 scenes around each date and keep them in memory.
+
+    The windows of all the dates are merged and searched in a single STAC
+    query. Each scene is downloaded once (S2_DATE_CONCURRENCY at a time, through
+    the chip cache) even if it falls in the window of several dates, and a
+    failed scene only fails the dates that need it.
+
+    Args:
+    - lat (float): Latitude of the center of the AOI.
+    - lon (float): Longitude of the center of the AOI.
+    - bands (List[str]): The bands to download.
+    - fechas (str): Dates separated by " || ", format YYYY-MM-DD.
+    - edge_size (int): The edge size in pixels.
+    - days_delay (int): Half-width of the window around each date, in days.
+    - selection (str): "all", "metadata" or "scl" (see stac_search.select_items).
+    - max_scenes (int): Scenes kept per date when selection is not "all".
+
+    Returns:
+    - Dict[str, np.ndarray]: The scenes (bands, height, width) by acquisition date.
+    - Dict[str, Dict]: The status of each requested date, with its scenes or error.
+    - Dict: The georeference of the scenes: UTM bbox, EPSG and resolution.
+    """
+    fechas = fechas.split(" || ")
+    print(fechas)
+    resolution = 10
+    max_cloud_cover = 50
+
+    bbox, ring, epsg = utm_bbox(lat, lon, edge_size, resolution)
+    georef = {"bbox": bbox, "epsg": epsg, "resolution": resolution}
+
+    # A repeated request is served from the chip cache without any network call.
+    # A search whose window includes today is only reused for a short time
+    cache = get_cache()
+    search_key = make_key(
+        "search", bbox, epsg, bands, sorted(fechas), days_delay, resolution, max_cloud_cover, selection, max_scenes
+    )
+    if cache is not None:
+        closed = all(window_closed(fecha, days_delay) for fecha in fechas)
+        entries = cache.get_search(search_key, CACHE_SEARCH_TTL if closed else CACHE_OPEN_SEARCH_TTL)
+        if entries is not None and all(cache.contains(e["key"]) for e in entries):
+            chips = [(e["date"], cache.get(e["key"])) for e in entries]
+            if all(chip is not None for _, chip in chips):
+                by_date = {}
+                for date, chip in chips:
+                    by_date.setdefault(date, []).append(chip[0])
+                images = {date: mosaic_scenes(scenes) for date, scenes in by_date.items()}
+                return images, {
+                    fecha: {"status": "ok", "scenes": sorted(set(e["date"] for e in entries if fecha in e["fechas"]))}
+                    for fecha in fechas
+                }, georef
+
+    items = search_items(ring, merge_windows(fechas, days_delay), max_cloud_cover)
+    assigned = assign_items(items, fechas, days_delay)
+    assigned = select_items(assigned, selection, max_scenes, bbox, epsg)
+
+    # Only the items some date needs, each one once
+    needed = {item.id: item for date_items in assigned.values() for item in date_items}
+    scenes = {}
+    failed = {}
+    if needed:
+        cube = stack_items(list(needed.values()), bands, bbox, epsg, resolution)
+        index = {item_id: i for i, item_id in enumerate(cube.id.values.tolist())}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(S2_DATE_CONCURRENCY, len(needed)))) as pool:
+            futures = {}
+            for item_id, item in needed.items():
+                key = chip_key(item_id, bbox, epsg, bands, resolution)
+                meta = {"item_id": item_id, "date": item_date(item), "bbox": bbox, "epsg": epsg}
+                futures[pool.submit(read_scene, cube, index[item_id], key, meta)] = (item, key)
+
+            for future in as_completed(futures):
+                item, key = futures[future]
+                try:
+                    scenes[item.id] = (item, key, future.result())
+                except Exception as e:
+                    print(f"Error en la escena {item.id}: {e}")
+                    failed[item.id] = str(e)
+
+    # Scenes of the same day (e.g. neighbouring tiles) are merged in a fixed
+    # order, not in the order their downloads finished
+    images = {}
+    entries = []
+    by_date = {}
+    for item, key, data in sorted(scenes.values(), key=lambda scene: (scene[0].datetime, scene[0].id)):
+        by_date.setdefault(item_date(item), []).append(data)
+        entries.append({
+            "date": item_date(item),
+            "key": key,
+            "fechas": [f for f, date_items in assigned.items() if item in date_items],
+        })
+    for date, date_scenes in by_date.items():
+        images[date] = mosaic_scenes(date_scenes)
+
+    report = {}
+    for fecha, date_items in assigned.items():
+        errors = {item.id: failed[item.id] for item in date_items if item.id in failed}
+        if errors:
+            report[fecha] = {"status": "error", "error": str(errors)}
+        else:
+            report[fecha] = {"status": "ok", "scenes": sorted(set(item_date(item) for item in date_items))}
+
+    if failed and not images:
+        raise RuntimeError(f"All the scenes failed: {failed}")
+    if cache is not None and not failed:
+        cache.put_search(search_key, entries)
+    return images, report, georef
+
+def download_sentinel2(
+        lat: float,
+        lon: float,
+        bands: List[str],
+        fechas: str,
+        edge_size: int,
+        path: str,
+        selection: str = "all",
+        max_scenes: int = 1,
+        output_format: str = "npy"
     ):
 
     try:
-        fechas = fechas.split(" || ")
-        print(fechas)
-
-        tempfile.tempdir = "/usr/src/app/public/output"
-        path = tempfile.mkdtemp()
-
-        for fecha in fechas:
-            days_delay = 10
-            print(f"Parámetros recibidos: lat={lat}, lon={lon}, fecha={fecha}")
-            fecha = datetime.strptime(fecha, "%Y-%m-%d")
-            start_date = (fecha - timedelta(days=days_delay)).strftime("%Y-%m-%d")
-            end_date = (fecha + timedelta(days=days_delay)).strftime("%Y-%m-%d")
-
-            da = cubo.create(
-                lat=lat,
-                lon=lon,
-                collection="sentinel-2-l2a",
-                bands=bands,
-                start_date=start_date,
-                end_date=end_date,
-                edge_size=edge_size,
-                units="px",
-                resolution=10,
-                query={"eo:cloud_cover": {"lt": 50}}
-            )
-
-            dates = da.time.values.astype("datetime64[D]").astype(str).tolist()
-            
-            for i in range(0, len(dates)):
-                path_image = f"{path}/image_{dates[i]}.npy"
-                data = da[i].to_numpy()
-                np.save(path_image, data)
-        return path
+        images, report, georef = fetch_sentinel2(
+            lat, lon, bands, fechas, edge_size, selection=selection, max_scenes=max_scenes
+        )
+        path = create_output_folder()
+        write_metadata(path, format=output_format, **georef)
+        for date_eval, data in images.items():
+            write_product(path, "image", date_eval, data)
+        return {"folder": path, "dates": report}
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=f"Error procesando Sentinel-2: {e}")
 
-async def get_sr(folder: str):
-    model = load_model_sr()
-    model.eval()
+# SR batching: at most SR_MAX_BATCH images per forward pass, and no more than
+# SR_BATCH_MEMORY_MB of estimated activations (SR_BYTES_PER_PIXEL per padded
+# input pixel, measured on CPU for HAN x4). The budget is per executor thread
+# (5 workers x 2 threads by default): 768 MB tiles the scenes over ~280 px
+SR_MAX_BATCH = int(os.getenv("SR_MAX_BATCH", "4"))
+SR_BATCH_MEMORY_MB = float(os.getenv("SR_BATCH_MEMORY_MB", "768"))
+SR_BYTES_PER_PIXEL = float(os.getenv("SR_BYTES_PER_PIXEL", "8192"))
+SR_PAD = 16
+SR_SCALE = 4
+
+# Tiled SR for scenes over the memory budget: "auto" tiles only those, "always"
+# tiles every scene and "never" disables it. SR_TILE_SIZE=0 derives the tile
+# size from SR_BATCH_MEMORY_MB
+SR_TILING = os.getenv("SR_TILING", "auto")
+SR_TILE_SIZE = int(os.getenv("SR_TILE_SIZE", "0"))
+SR_TILE_OVERLAP = int(os.getenv("SR_TILE_OVERLAP", "16"))
+SR_TILE_BLEND = os.getenv("SR_TILE_BLEND", "feather")
+
+def sr_batch_size(height: int, width: int, max_batch: int = SR_MAX_BATCH, memory_mb: float = SR_BATCH_MEMORY_MB) -> int:
+    """
+    Number of (height, width) images that fit in a forward pass.
+    """
+    per_image = (height + 2 * SR_PAD) * (width + 2 * SR_PAD) * SR_BYTES_PER_PIXEL
+    return max(1, min(max_batch, int(memory_mb * 1024 ** 2 // per_image)))
+
+def pad_edge_(batch: np.ndarray, pad: int) -> np.ndarray:
+    """
+    Fill in place the borders of a (..., H, W) array, whose center
+    [..., pad:-pad, pad:-pad] is already set, replicating the edge pixels
+    (same as np.pad mode="edge").
+    """
+    batch[..., :pad, :] = batch[..., pad:pad + 1, :]
+    batch[..., -pad:, :] = batch[..., -pad - 1:-pad, :]
+    batch[..., :, :pad] = batch[..., :, pad:pad + 1]
+    batch[..., :, -pad:] = batch[..., :, -pad - 1:-pad]
+    return batch
+
+def sr_tile_size(memory_mb: float = SR_BATCH_MEMORY_MB) -> int:
+    """
+    Largest tile side (multiple of 8, at least 64) whose forward pass, with
+    its padding, fits in the memory budget.
+    """
+    if SR_TILE_SIZE > 0:
+        return SR_TILE_SIZE
+    side = int((memory_mb * 1024 ** 2 / SR_BYTES_PER_PIXEL) ** 0.5) - 2 * SR_PAD
+    return max(64, side // 8 * 8)
 
-    path_list = [folder + "/" + x for x in os.listdir(folder)]
-    path_list_sr = []
-    print(path_list)
+def sr_needs_tiling(height: int, width: int) -> bool:
+    if SR_TILING == "always":
+        return True
+    if SR_TILING == "never":
+        return False
+    return (height + 2 * SR_PAD) * (width + 2 * SR_PAD) * SR_BYTES_PER_PIXEL > SR_BATCH_MEMORY_MB * 1024 ** 2
 
-    for path_i in path_list:
-        date_eval = path_i.split("/")[-1].split("_")[1].split(".")[0]
-        # print(date_eval)
-        lr = np.load(path_i)
-        lr = lr[0:3] / 10000
+def super_resolve_tiled(
+        model,
+        lr: np.ndarray,
+        tile: int = None,
+        overlap: int = SR_TILE_OVERLAP,
+        batch_size: int = None,
+        mode: str = SR_TILE_BLEND
+    ) -> np.ndarray:
+    """
+    Super-resolve (x4) a scene of any size in overlapping tiles, blending the
+    seams, so the peak memory is flat.
 
-        ## Add a padding of 16 pixels
-        lr = np.pad(lr, ((0,0),(16, 16),(16, 16)), mode="edge")
-        image_torch = torch.from_numpy(lr).float()
+    Args:
+    - model: The SR model.
+    - lr (np.ndarray): The scene (bands, height, width) in reflectance x 10000.
+    - tile (int, optional): The tile size, by default from the memory budget.
+    - overlap (int): The overlap between tiles, in input pixels.
+    - batch_size (int, optional): Tiles per forward pass, by default as many
+      as fit in the memory budget (up to SR_MAX_BATCH).
+    - mode (str): The blend window, "feather" or "gaussian".
 
+    Returns:
+    - np.ndarray: The SR image (3, 4 * height, 4 * width).
+    """
+    tile = tile or sr_tile_size()
+    if batch_size is None:
+        batch_size = max(1, min(SR_MAX_BATCH, int(SR_BATCH_MEMORY_MB * 1024 ** 2 // (tile * tile * SR_BYTES_PER_PIXEL))))
+
+    _, height, width = lr.shape
+    padded = np.empty((3, height + 2 * SR_PAD, width + 2 * SR_PAD), dtype=np.float32)
+    np.divide(lr[0:3], 10000, out=padded[:, SR_PAD:-SR_PAD, SR_PAD:-SR_PAD], casting="unsafe")
+    pad_edge_(padded, SR_PAD)
+
+    def forward(batch):
         with torch.no_grad():
-            sr_img = model(image_torch[None]).squeeze().numpy()
+            return model(torch.from_numpy(batch)).numpy()
 
-        ## Remove the padding
-        super_img = sr_img[:,64:-64,64:-64]
+    sr_img = tiled_apply(forward, padded, tile, overlap, 3, scale=SR_SCALE, batch_size=batch_size, mode=mode)
 
-        path_sr = f"{folder}/sr_{date_eval}.npy"
-        path_list_sr.append(path_sr)
-        np.save(path_sr, super_img)
+    ## Remove the padding
+    crop = SR_PAD * SR_SCALE
+    return sr_img[:, crop:-crop, crop:-crop]
 
-    return path_list_sr
+def super_resolve_batch(model, images: List[np.ndarray], max_batch: int = None) -> List[np.ndarray]:
+    """
+    Super-resolve (x4) the RGB bands of several Sentinel-2 scenes, stacking the
+    scenes with the same shape in batches (see sr_batch_size). Scenes over the
+    memory budget are super-resolved in tiles (see super_resolve_tiled).
 
+    Args:
+    - model: The SR model.
+    - images (List[np.ndarray]): The scenes (bands, height, width) in reflectance x 10000.
+    - max_batch (int, optional): Fixed batch size, instead of the memory budget.
 
-def preprocess_image_for_inference(image_path, normalize=False, mean=None, std=None):
-    image = np.load(image_path).squeeze()
-    image = np.moveaxis(image, 0, -1)
-    preprocess_pipeline = transforms.Compose([
-        transforms.ToTensor()  
-    ])
-    if normalize and mean is not None and std is not None:
-        preprocess_pipeline.transforms.append(transforms.Normalize(mean=mean, std=std))
+    Returns:
+    - List[np.ndarray]: The SR images (3, 4 * height, 4 * width), in the same order.
+    """
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape[1:], []).append(i)
 
-    image = preprocess_pipeline(image).float()
-    image = image.unsqueeze(0)  
+    results = [None] * len(images)
+    crop = SR_PAD * SR_SCALE
+    for (height, width), indices in groups.items():
+        if sr_needs_tiling(height, width):
+            for i in indices:
+                results[i] = super_resolve_tiled(model, images[i])
+            continue
 
-    return image
+        batch_size = max_batch or sr_batch_size(height, width)
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
 
-def inference_building(normalize, mean, std, path_to_image, threshold):
-    checkpoint = load_model_build()
-    model = Unet(encoder_name="mit_b1", in_channels=3, classes=1, encoder_weights=None)  # Set encoder_weights to None
-    filter_ckpt = {k: v for k, v in checkpoint.items()}
-    
-    model.load_state_dict(filter_ckpt)
-    model = model.cpu()
-    model.eval()
+            # Scale and pad straight into the float32 batch, without temporaries
+            batch = np.empty((len(chunk), 3, height + 2 * SR_PAD, width + 2 * SR_PAD), dtype=np.float32)
+            for j, i in enumerate(chunk):
+                np.divide(images[i][0:3], 10000, out=batch[j, :, SR_PAD:-SR_PAD, SR_PAD:-SR_PAD], casting="unsafe")
+            pad_edge_(batch, SR_PAD)
+
+            with torch.no_grad():
+                sr_batch = model(torch.from_numpy(batch)).numpy()
+
+            ## Remove the padding
+            for j, i in enumerate(chunk):
+                results[i] = sr_batch[j, :, crop:-crop, crop:-crop]
+    return results
+
+def super_resolve(model, lr: np.ndarray) -> np.ndarray:
+    """
+    Super-resolve (x4) the RGB bands of a Sentinel-2 scene.
+
+    Args:
+    - model: The SR model.
+    - lr (np.ndarray): The scene (bands, height, width) in reflectance x 10000.
+
+    Returns:
+    - np.ndarray: The SR image (3, 4 * height, 4 * width).
+    """
+    return super_resolve_batch(model, [lr], max_batch=1)[0]
+
+async def get_sr(folder: str, model=None, skip_existing: bool = True):
+    async with artifact_store.get_store().ahold(folder):
+        return await executor.run(
+            sr_folder, folder, model=model if executor.shares_models() else None, skip_existing=skip_existing
+        )
+
+def sr_folder(folder: str, model=None, skip_existing: bool = True):
+    if model is None:
+        model = registry.get("sr")
+
+    # The scenes are taken from the manifest; the dates with SR are skipped
+    images = product_paths(folder, "image")
+    srs = product_paths(folder, "sr") if skip_existing else {}
+    todo = [d for d in images if d not in srs]
+    print(todo)
+
+    # One batch at a time: the scenes are memory-mapped and each SR image is
+    # written before the next batch, so the peak does not grow with the dates
+    with memory.track_peak("sr"):
+        for start in range(0, len(todo), SR_MAX_BATCH):
+            chunk = todo[start:start + SR_MAX_BATCH]
+            super_imgs = super_resolve_batch(model, [read_product(images[d]) for d in chunk])
+            for date_eval, super_img in zip(chunk, super_imgs):
+                srs[date_eval] = write_product(folder, "sr", date_eval, super_img)
+
+    return [srs[d] for d in images if d in srs]
+
+
+# Building segmentation parameters
+BUILD_THRESHOLD = 0.5
+BUILD_MEAN = [0.2108307 , 0.1849077 , 0.15864254]
+BUILD_STD = [0.05045007, 0.0406715 , 0.03748639]
+# SR images (or tiles) per forward pass of the U-Net
+BUILD_BATCH_SIZE = int(os.getenv("BUILD_BATCH_SIZE", "4"))
+
+# Sliding-window segmentation: "auto" for images larger than BUILD_TILE_SIZE,
+# "always" or "never". Tiles are padded to a multiple of 32 for mit_b1
+BUILD_TILING = os.getenv("BUILD_TILING", "auto")
+BUILD_TILE_SIZE = int(os.getenv("BUILD_TILE_SIZE", "512"))
+BUILD_TILE_OVERLAP = int(os.getenv("BUILD_TILE_OVERLAP", "64"))
+BUILD_TILE_BLEND = os.getenv("BUILD_TILE_BLEND", "feather")
+
+def normalize_batch_(batch: np.ndarray, mean=BUILD_MEAN, std=BUILD_STD) -> np.ndarray:
+    """Normalize a (n, 3, H, W) float32 batch in place with the stored mean/std."""
+    batch -= np.asarray(mean, dtype=np.float32)[:, None, None]
+    batch /= np.asarray(std, dtype=np.float32)[:, None, None]
+    return batch
 
-    image = preprocess_image_for_inference(path_to_image, normalize=normalize, mean=mean, std=std).cpu()
+# The mit_b1 encoder downsamples by 32
+BUILD_STRIDE = 32
 
+def build_forward(model, batch: np.ndarray) -> np.ndarray:
+    """
+    Logits of a normalized (n, 3, H, W) batch. H and W are padded (edge) up
+    to a multiple of BUILD_STRIDE for the encoder, and the logits cropped back.
+    """
+    height, width = batch.shape[2:]
+    pad_h, pad_w = -height % BUILD_STRIDE, -width % BUILD_STRIDE
+    if pad_h or pad_w:
+        batch = np.pad(batch, ((0, 0), (0, 0), (0, pad_h), (0, pad_w)), mode="edge")
     with torch.no_grad():
-        output = model(image)
-        output = (output > threshold).float()
-    output = output.squeeze().numpy()
-    return output
-
-async def get_buildings(folder: str):
-    path_list = [folder + "/" + x for x in os.listdir(folder)]
-    path_buildings = []
-
-    threshold = 0.5
-    normalize = True
-    mean = [0.2108307 , 0.1849077 , 0.15864254]
-    std = [0.05045007, 0.0406715 , 0.03748639]
-
-    for path_i in path_list:
-        try:
-            date_eval = path_i.split("/")[-1].split("_")[1].split(".")[0]
-            print(date_eval)
-            pred_np_buildings = inference_building(normalize, mean, std, path_i, threshold)
-
-            path_sr = f"{folder}/build_{date_eval}.npy"
-            np.save(path_sr, pred_np_buildings)
-            path_buildings.append(path_sr)
-        except Exception as e:
-            print(e)
+        logits = model(torch.from_numpy(batch)).numpy()
+    return logits[:, :, :height, :width]
+
+def build_needs_tiling(height: int, width: int) -> bool:
+    if BUILD_TILING == "always":
+        return True
+    if BUILD_TILING == "never":
+        return False
+    return max(height, width) > BUILD_TILE_SIZE
+
+def segment_buildings_tiled(
+        model,
+        image: np.ndarray,
+        tile: int = BUILD_TILE_SIZE,
+        overlap: int = BUILD_TILE_OVERLAP,
+        batch_size: int = BUILD_BATCH_SIZE,
+        threshold: float = BUILD_THRESHOLD,
+        mode: str = BUILD_TILE_BLEND
+    ) -> np.ndarray:
+    """
+    Segment the buildings of a large SR image with a sliding window. The
+    logits of the overlapping tiles are blended before thresholding, so the
+    peak memory depends on the tile size only.
+
+    Args:
+    - model: The building model.
+    - image (np.ndarray): The SR image (3, H, W) in reflectance 0-1.
+    - tile (int): The tile size.
+    - overlap (int): The overlap between tiles.
+    - batch_size (int): The tiles per forward pass.
+    - threshold (float): The mask threshold.
+    - mode (str): The blend window, "feather" or "gaussian".
+
+    Returns:
+    - np.ndarray: The (H, W) float32 0/1 mask.
+    """
+    # The tiles of each batch are already copies (np.stack): normalize them in
+    # place instead of a normalized copy of the whole image. The tiles of an
+    # image smaller than the tile size are not multiples of 32, build_forward pads them
+    def forward(batch):
+        return build_forward(model, normalize_batch_(batch))
+
+    logits = tiled_apply(forward, image, tile, overlap, 1, batch_size=batch_size, mode=mode)
+    return (logits[0] > threshold).astype(np.float32)
+
+def segment_buildings_batch(
+        model,
+        images: List[np.ndarray],
+        batch_size: int = BUILD_BATCH_SIZE,
+        threshold: float = BUILD_THRESHOLD
+    ) -> Tuple[List[np.ndarray], List[float]]:
+    """
+    Segment the buildings of several SR images, stacking the images with the
+    same shape in batches. Images larger than the tile size are segmented
+    with a sliding window (see segment_buildings_tiled).
+
+    Args:
+    - model: The building model.
+    - images (List[np.ndarray]): The SR images (3, H, W) in reflectance 0-1.
+    - batch_size (int): The images per forward pass.
+    - threshold (float): The mask threshold.
+
+    Returns:
+    - List[np.ndarray]: The (H, W) float32 0/1 masks, in the same order.
+    - List[float]: The seconds spent on each image (its share of the batch).
+    """
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(i)
+
+    masks = [None] * len(images)
+    seconds = [0.0] * len(images)
+    for shape, indices in groups.items():
+        if build_needs_tiling(*shape[1:]):
+            for i in indices:
+                tic = time.perf_counter()
+                masks[i] = segment_buildings_tiled(model, images[i], batch_size=batch_size, threshold=threshold)
+                seconds[i] = time.perf_counter() - tic
             continue
-    
-    return path_buildings
+
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            tic = time.perf_counter()
+
+            batch = np.empty((len(chunk), *shape), dtype=np.float32)
+            for j, i in enumerate(chunk):
+                batch[j] = images[i]
+            normalize_batch_(batch)
+            output = (build_forward(model, batch) > threshold).astype(np.float32)
+
+            elapsed = (time.perf_counter() - tic) / len(chunk)
+            for j, i in enumerate(chunk):
+                masks[i] = output[j, 0]
+                seconds[i] = elapsed
+    return masks, seconds
+
+def segment_buildings(model, image: np.ndarray, threshold: float = BUILD_THRESHOLD) -> np.ndarray:
+    """
+    Segment the buildings of an SR image (3, H, W) into a (H, W) 0/1 mask.
+    """
+    return segment_buildings_batch(model, [image], batch_size=1, threshold=threshold)[0][0]
+
+async def get_buildings(folder: str, model=None, skip_existing: bool = True):
+    async with artifact_store.get_store().ahold(folder):
+        return await executor.run(
+            buildings_folder, folder, model=model if executor.shares_models() else None, skip_existing=skip_existing
+        )
+
+def buildings_folder(folder: str, model=None, skip_existing: bool = True):
+    if model is None:
+        model = registry.get("building")
+
+    # Only the SR products are segmented; the dates with a mask are skipped
+    srs = product_paths(folder, "sr")
+    builds = product_paths(folder, "build") if skip_existing else {}
+    todo = [d for d in srs if d not in builds]
+    print(todo)
+
+    dates = {d: {"path": path, "seconds": 0.0, "cached": True} for d, path in builds.items() if d in srs}
+    with memory.track_peak("buildings"):
+        for start in range(0, len(todo), BUILD_BATCH_SIZE):
+            chunk = todo[start:start + BUILD_BATCH_SIZE]
+            masks, seconds = segment_buildings_batch(model, [read_product(srs[d]) for d in chunk])
+            for date_eval, mask, elapsed in zip(chunk, masks, seconds):
+                tic = time.perf_counter()
+                path_build = write_product(folder, "build", date_eval, mask)
+                dates[date_eval] = {"path": path_build, "seconds": round(elapsed + time.perf_counter() - tic, 3)}
+
+    dates = dict(sorted(dates.items()))
+    return {"paths": [d["path"] for d in dates.values()], "dates": dates}
 
 
 def normalize_minmax(image):
     image = (image - np.min(image)) / (np.max(image) - np.min(image))
     return image
 
-async def get_vis(folder: str):
-    # i = 0
-    images = ["{}/{}".format(folder, x) for x in os.listdir(folder) if x.startswith("image")]
-    srs = ["{}/{}".format(folder, x) for x in os.listdir(folder) if x.startswith("sr")]
-    builds = ["{}/{}".format(folder, x) for x in os.listdir(folder) if x.startswith("build")]
-    
-    images.sort()
-    srs.sort()
-    builds.sort()
-
-    for i in range(len(images)):
-        date_eval = images[i].split("_")[-1].split(".")[0]
-        # "/usr/src/app/src/public/tmp5ebko6_k/s2_2024-09-07.png"
-
-        img_np = np.moveaxis(np.load(images[i]), 0, -1)
-        img_np = (img_np / 10000 * 3).clip(0, 1)
-        img_np_equalized = exposure.equalize_hist(img_np)
-
-        sr_np = np.moveaxis(np.load(srs[i]), 0, -1)
-        sr_np = (sr_np * 3).clip(0, 1)
-        sr_np_equalized = exposure.equalize_hist(sr_np)
-
-        build_np = np.load(builds[i])
-        build_np = build_np.clip(0, 1)
-        
-        # Guardar la imagen original individualmente
-        plt.imshow(img_np_equalized[:, :, [0, 1, 2]])
-        # plt.title("S2 - 10m")
-        plt.axis("off")
-        image_filename = f"s2_{date_eval}.png"
-        image_path = os.path.join(folder, image_filename)
-        plt.savefig(image_path)
-        plt.close()
-
-        # Guardar la imagen de superresolución individualmente
-        plt.imshow(sr_np_equalized[:, :, [0, 1, 2]])
-        # plt.title("S2 SR - 2.5m")
-        plt.axis("off")
-        sr_filename = f"sr_{date_eval}.png"
-        sr_path = os.path.join(folder, sr_filename)
-        plt.savefig(sr_path)
-        plt.close()
-
-        # Guardar la imagen de edificaciones individualmente
-        plt.imshow(build_np, cmap="gray")
-        # plt.title("Edificaciones")
-        plt.axis("off")
-        build_filename = f"build_{date_eval}.png"
-        build_path = os.path.join(folder, build_filename)
-        plt.savefig(build_path)
-        plt.close()
-
-        # Guardar la imagen combinada
-        fig, ax = plt.subplots(1, 3, figsize=(15, 5))
-        ax[0].imshow(img_np_equalized[:, :, [0, 1, 2]])
-        # ax[0].set_title("S2 - 10m")
-        ax[0].axis("off")
-        ax[1].imshow(sr_np_equalized[:, :, [0, 1, 2]])
-        # ax[1].set_title("S2 SR - 2.5m")
-        ax[1].axis("off")
-        ax[2].imshow(build_np, cmap="gray")
-        # ax[2].set_title("Edificaciones")
-        ax[2].axis("off")
-        combined_filename = f"combined_{date_eval}.png"
-        combined_path = os.path.join(folder, combined_filename)
-        plt.savefig(combined_path)
-        plt.close()
-
-    list_path = [os.path.join(folder, x) for x in os.listdir(folder) if x.endswith(".png")]
+async def get_vis(folder: str, skip_existing: bool = True):
+    async with artifact_store.get_store().ahold(folder):
+        return await executor.run(vis_folder, folder, skip_existing=skip_existing)
+
+def vis_folder(folder: str, skip_existing: bool = True):
+    # The products of each date are matched by date, from the manifest
+    images = product_paths(folder, "image")
+    srs = product_paths(folder, "sr")
+    builds = product_paths(folder, "build")
+    rendered = product_paths(folder, "render_combined") if skip_existing else {}
+
+    todo = [d for d in images if d in srs and d in builds and d not in rendered]
+    if todo:
+        with memory.track_peak("vis"):
+            stretch = folder_stretch(folder, lambda: [read_product(p) for p in images.values()])
+            for date_eval in todo:
+                # "/usr/src/app/src/public/tmp5ebko6_k/s2_2024-09-07.png"
+                render_date(
+                    folder, date_eval, read_product(images[date_eval]), read_product(srs[date_eval]),
+                    read_product(builds[date_eval]), stretch
+                )
+
+    list_path = []
+    for name in RENDERS:
+        list_path += product_paths(folder, f"render_{name}").values()
     return list_path
+
+# Maximum side of the progressive previews, in pixels
+PREVIEW_MAX_SIZE = int(os.getenv("VHR_PREVIEW_MAX_SIZE", "256"))
+
+def preview_folder(folder: str, prefix: str, max_size: int = PREVIEW_MAX_SIZE) -> Dict[str, str]:
+    """
+    Render cheap previews of the image or sr products of a folder, subsampled
+    to at most max_size per side, while the next stages are still running.
+
+    Returns:
+    - Dict[str, str]: The path of the preview of each date.
+    """
+    stretch = folder_stretch(folder, lambda: [read_product(p) for p in list_products(folder, "image")])
+    previews = {}
+    for date_eval, path in product_paths(folder, prefix).items():
+        array = read_product(path)
+        step = max(1, -(-max(array.shape[1:]) // max_size))
+        rgb = apply_stretch(array[:, ::step, ::step], stretch, scale=1e-4 if prefix == "image" else 1.0)
+        previews[date_eval] = save_image(rgb, os.path.join(folder, f"preview_{prefix}_{date_eval}"))
+        register_product(folder, f"preview_{prefix}", date_eval, previews[date_eval])
+    return previews
+
+# Images rendered for each date, registered in the manifest as render_<name>
+RENDERS = ("s2", "sr", "build", "combined")
+
+def render_date(
+        folder: str,
+        date_eval: str,
+        image: np.ndarray,
+        sr: np.ndarray,
+        build: np.ndarray,
+        stretch: Dict = None
+    ) -> List[str]:
+    """
+    Render the S2, SR, buildings and combined images of one date at native
+    resolution. Safe to call from several threads at once.
+
+    Args:
+    - folder (str): The output folder.
+    - date_eval (str): The date of the products.
+    - image (np.ndarray): The S2 scene (bands, height, width).
+    - sr (np.ndarray): The SR image (3, height, width).
+    - build (np.ndarray): The building mask (height, width).
+    - stretch (Dict, optional): The stretch of the series (see render.compute_stretch),
+      by default computed from this scene.
+
+    Returns:
+    - List[str]: The paths of the images.
+    """
+    if stretch is None:
+        stretch = compute_stretch([image])
+
+    # S2 and SR share the stretch: both are rendered from reflectance
+    s2_rgb = apply_stretch(image, stretch, scale=1e-4)
+    sr_rgb = apply_stretch(sr, stretch)
+    build_gray = mask_to_gray(build)
+
+    paths = []
+    for name, array in zip(RENDERS, (s2_rgb, sr_rgb, build_gray, composite([s2_rgb, sr_rgb, build_gray]))):
+        path = save_image(array, os.path.join(folder, f"{name}_{date_eval}"))
+        register_product(folder, f"render_{name}", date_eval, path, shape=list(array.shape))
+        paths.append(path)
+    return paths
+
+
+async def get_footprints(
+        folder: str,
+        dates: List[str] = None,
+        simplify: float = 2.5,
+        min_area: float = 25.0,
+        bbox: List[float] = None,
+        crs: str = "wgs84",
+        output: str = "geojson"
+    ):
+    async with artifact_store.get_store().ahold(folder):
+        return await executor.run(footprints_folder, folder, dates, simplify, min_area, bbox, crs, output)
+
+def footprints_folder(
+        folder: str,
+        dates: List[str] = None,
+        simplify: float = 2.5,
+        min_area: float = 25.0,
+        bbox: List[float] = None,
+        crs: str = "wgs84",
+        output: str = "geojson"
+    ):
+    """
+    Vectorize the building masks of a folder into simplified polygons.
+
+    Args:
+    - folder (str): The output folder.
+    - dates (List[str], optional): Only these dates. All by default.
+    - simplify (float): The simplification tolerance, in meters.
+    - min_area (float): Polygons smaller than this (m2) are dropped.
+    - bbox (List[float], optional): Keep the buildings intersecting this WGS84 bbox.
+    - crs (str): "wgs84" or "scene" (UTM of the scene).
+    - output (str): "geojson" (dict) or "geoparquet" (bytes).
+
+    Returns:
+    - Dict | bytes: The GeoJSON FeatureCollection or the GeoParquet file.
+
+    Raises:
+    - ValueError: If the output or crs is unknown, or the folder has no georeference.
+    """
+    if output not in ("geojson", "geoparquet"):
+        raise ValueError(f"Unknown output '{output}', use 'geojson' or 'geoparquet'")
+    if crs not in ("wgs84", "scene"):
+        raise ValueError(f"Unknown crs '{crs}', use 'wgs84' or 'scene'")
+    metadata = read_metadata(folder)
+    if "epsg" not in metadata:
+        raise ValueError(f"The folder {folder} has no georeference")
+    epsg = metadata["epsg"]
+
+    features = []
+    for date_eval, path in product_paths(folder, "build").items():
+        if dates and date_eval not in dates:
+            continue
+        mask = read_product(path)
+        transform = from_bounds(*metadata["bbox"], mask.shape[1], mask.shape[0])
+        features += mask_to_features(mask, transform, epsg, date_eval, simplify, min_area)
+    features = filter_bbox(features, bbox)
+
+    if output == "geoparquet":
+        return to_geoparquet(features, crs, epsg)
+    return to_geojson(features, crs, epsg)
+
+
+async def get_pipeline(
+        lat: float,
+        lon: float,
+        bands: List[str],
+        fechas: str,
+        edge_size: int,
+        path: str,
+        selection: str = "all",
+        max_scenes: int = 1,
+        output_format: str = "npy",
+        save_intermediates: bool = False,
+        sr_model=None,
+        build_model=None
+    ):
+    """
+    Run download -> SR -> buildings -> PNG passing the arrays in memory.
+
+    Only the PNGs are written, plus the .npy products of every stage when
+    save_intermediates is True.
+    """
+    def fetch() -> Tuple[str, Dict[str, np.ndarray], Dict[str, Dict]]:
+        # The folder is registered (SQLite) and written (flock) off the event loop too
+        images, report, georef = fetch_sentinel2(
+            lat, lon, bands, fechas, edge_size, selection=selection, max_scenes=max_scenes
+        )
+        folder = create_output_folder()
+        write_metadata(folder, format=output_format, **georef)
+        return folder, images, report
+
+    try:
+        folder, images, report = await asyncio.to_thread(fetch)
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=f"Error procesando Sentinel-2: {e}")
+
+    if not executor.shares_models():
+        sr_model = build_model = None
+    async with artifact_store.get_store().ahold(folder):
+        result = await executor.run(process_images, folder, images, save_intermediates, sr_model, build_model)
+    return {**result, "dates": report}
+
+def process_images(
+        folder: str,
+        images: Dict[str, np.ndarray],
+        save_intermediates: bool = False,
+        sr_model=None,
+        build_model=None
+    ) -> Dict:
+    if sr_model is None:
+        sr_model = registry.get("sr")
+    if build_model is None:
+        build_model = registry.get("building")
+
+    with memory.track_peak("pipeline"):
+        dates = sorted(images)
+        srs = dict(zip(dates, super_resolve_batch(sr_model, [images[d] for d in dates])))
+        builds = dict(zip(dates, segment_buildings_batch(build_model, [srs[d] for d in dates])[0]))
+
+        stretch = folder_stretch(folder, lambda: [images[d] for d in dates])
+        products = {}
+        for date_eval, image in sorted(images.items()):
+            sr = srs[date_eval]
+            build = builds[date_eval]
+
+            pngs = render_date(folder, date_eval, image, sr, build, stretch)
+            products[date_eval] = {"png": pngs}
+
+            if save_intermediates:
+                for prefix, data in (("image", image), ("sr", sr), ("build", build)):
+                    products[date_eval][prefix] = write_product(folder, prefix, date_eval, data)
+
+    return {"folder": folder, "products": products}
+
+
+# AOI workspaces: one persistent folder per snapped bbox and parameters, where
+# the products of each date are kept, so extending a time series only
+# downloads and processes the new dates
+def workspace_folder(
+        lat: float,
+        lon: float,
+        bands: List[str],
+        edge_size: int,
+        selection: str = "all",
+        max_scenes: int = 1,
+        output_format: str = "npy",
+        days_delay: int = 10
+    ) -> str:
+    """
+    Get (and create) the workspace folder of an AOI.
+
+    The key is the bbox snapped to the 10 m grid plus the parameters that
+    change the products, so nearby points of the same chip share it. The
+    bands keep their order: the products are stored in that order and SR
+    reads the first three as RGB.
+
+    Returns:
+    - str: The path of the workspace folder.
+    """
+    resolution = 10
+    bbox, _, epsg = utm_bbox(lat, lon, edge_size, resolution)
+    key = make_key("workspace", bbox, epsg, list(bands), resolution, selection, max_scenes, output_format, days_delay)
+    folder = os.path.join(OUTPUT_DIR, f"aoi_{key[:16]}")
+    os.makedirs(folder, exist_ok=True)
+    artifact_store.get_store().touch(folder, force=True)
+    if not read_metadata(folder):
+        write_metadata(
+            folder, format=output_format, bbox=bbox, epsg=epsg, resolution=resolution,
+            bands=bands, selection=selection, max_scenes=max_scenes, fechas={}
+        )
+    return folder
+
+@contextlib.asynccontextmanager
+async def workspace_lock(folder: str):
+    """
+    Hold the lock of a workspace: the requests for the same AOI run one after
+    the other, in this worker and in the others (flock on the folder).
+    """
+    file = open(os.path.join(folder, ".lock"), "w")
+    try:
+        await asyncio.to_thread(fcntl.flock, file, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the file releases the lock
+        file.close()
+
+def download_missing(
+        folder: str,
+        lat: float,
+        lon: float,
+        bands: List[str],
+        fechas: List[str],
+        edge_size: int,
+        selection: str = "all",
+        max_scenes: int = 1,
+        days_delay: int = 10
+    ) -> Dict[str, Dict]:
+    """
+    Download the scenes of the dates a workspace does not have yet.
+
+    Only the dates that succeed are memoized (metadata "fechas": requested
+    date -> scene dates), so a failed date is retried by the next request.
+    A date whose window was not over when it was searched (metadata
+    "fechas_searched": requested date -> time of the search) is searched
+    again after CACHE_OPEN_SEARCH_TTL, to get the scenes published later.
+
+    Returns:
+    - Dict[str, Dict]: The status of the downloaded dates, with their scenes or error.
+    """
+    metadata = read_metadata(folder)
+    known = metadata.get("fechas", {})
+    searched = metadata.get("fechas_searched", {})
+    now = time.time()
+
+    def stale(fecha: str) -> bool:
+        if fecha not in known:
+            return True
+        if fecha in searched:
+            return now - searched[fecha] > CACHE_OPEN_SEARCH_TTL
+        # Memoized before the searches were timed
+        return not window_closed(fecha, days_delay)
+
+    missing = [f for f in fechas if stale(f)]
+    if not missing:
+        return {}
+
+    images, report, _ = fetch_sentinel2(
+        lat, lon, bands, " || ".join(missing), edge_size, days_delay, selection=selection, max_scenes=max_scenes
+    )
+    stored = product_paths(folder, "image")
+    for date_eval, data in images.items():
+        if date_eval not in stored:
+            write_product(folder, "image", date_eval, data)
+
+    for fecha, status in report.items():
+        if status["status"] != "ok":
+            continue
+        known[fecha] = status["scenes"]
+        if window_closed(fecha, days_delay):
+            searched.pop(fecha, None)
+        else:
+            searched[fecha] = now
+    write_metadata(folder, fechas=known, fechas_searched=searched)
+    return report
+
+def change_summary(folder: str, dates: List[str]) -> List[Dict]:
+    """
+    Compare the building masks of consecutive dates of a workspace.
+
+    Args:
+    - folder (str): The workspace folder.
+    - dates (List[str]): The scene dates to compare, in any order.
+
+    Returns:
+    - List[Dict]: One entry per pair of consecutive dates with the built-up
+      area (m2) of each one, the area added and removed, and the IoU.
+    """
+    builds = product_paths(folder, "build")
+    metadata = read_metadata(folder)
+    pixel_area = (metadata.get("resolution", 10) / SR_SCALE) ** 2
+
+    summary = []
+    previous, previous_mask = None, None
+    for date_eval in sorted(set(dates) & set(builds)):
+        mask = read_product(builds[date_eval]) > 0
+        if previous_mask is not None and previous_mask.shape == mask.shape:
+            added = int(np.count_nonzero(mask & ~previous_mask))
+            removed = int(np.count_nonzero(previous_mask & ~mask))
+            union = int(np.count_nonzero(mask | previous_mask))
+            summary.append({
+                "from": previous,
+                "to": date_eval,
+                "built_from_m2": round(np.count_nonzero(previous_mask) * pixel_area, 1),
+                "built_to_m2": round(np.count_nonzero(mask) * pixel_area, 1),
+                "added_m2": round(added * pixel_area, 1),
+                "removed_m2": round(removed * pixel_area, 1),
+                "iou": round((union - added - removed) / union, 4) if union else 1.0,
+            })
+        previous, previous_mask = date_eval, mask
+    return summary
+
+def process_workspace(folder: str, dates: List[str], sr_model=None, build_model=None) -> Dict:
+    """
+    Run SR, buildings and PNGs for the dates of a workspace without them, and
+    summarize the changes between the requested dates.
+    """
+    sr_folder(folder, sr_model)
+    buildings_folder(folder, build_model)
+    vis_folder(folder)
+
+    kinds = ["image", "sr", "build"] + [f"render_{name}" for name in RENDERS]
+    paths = {kind: product_paths(folder, kind) for kind in kinds}
+    products = {}
+    for date_eval in sorted(dates):
+        products[date_eval] = {kind: paths[kind].get(date_eval) for kind in ("image", "sr", "build")}
+        products[date_eval]["png"] = [paths[f"render_{name}"].get(date_eval) for name in RENDERS]
+    return {"products": products, "changes": change_summary(folder, dates)}
+
+async def get_workspace(
+        lat: float,
+        lon: float,
+        bands: List[str],
+        fechas: str,
+        edge_size: int,
+        path: str,
+        selection: str = "all",
+        max_scenes: int = 1,
+        output_format: str = "npy",
+        sr_model=None,
+        build_model=None
+    ):
+    """
+    Process a time series in the workspace of its AOI, computing only the
+    dates that are not there yet.
+
+    Returns:
+    - Dict: The workspace folder, the new dates, the status of every
+      requested date, the products by scene date and the changes between
+      consecutive dates.
+    """
+    fechas = fechas.split(" || ")
+    folder = await asyncio.to_thread(
+        workspace_folder, lat, lon, bands, edge_size, selection, max_scenes, output_format
+    )
+    async with workspace_lock(folder):
+        async with artifact_store.get_store().ahold(folder):
+            try:
+                report = await asyncio.to_thread(
+                    download_missing, folder, lat, lon, bands, fechas, edge_size, selection, max_scenes
+                )
+            except Exception as e:
+                print(e)
+                raise HTTPException(status_code=500, detail=f"Error procesando Sentinel-2: {e}")
+
+            known = read_metadata(folder).get("fechas", {})
+            dates = {}
+            for fecha in fechas:
+                if fecha in known:
+                    dates[fecha] = {"status": "ok", "scenes": known[fecha], "cached": fecha not in report}
+                else:
+                    dates[fecha] = report.get(fecha, {"status": "error", "error": "No scenes"})
+            scene_dates = sorted(set(d for f in fechas for d in known.get(f, [])))
+
+            if not executor.shares_models():
+                sr_model = build_model = None
+            result = await executor.run(process_workspace, folder, scene_dates, sr_model, build_model)
+    return {"folder": folder, "new_dates": sorted(report), "dates": dates, **result}
+
+
+# Stages of the asynchronous Sentinel-2 jobs (see jobs.py). Each stage gets
+# the job parameters and the result so far, and returns the fields to add
+# The quicklooks of the chips and the subsampled SR are published as previews
+# (see jobs.JobRunner) before the slower stages finish
+async def job_download(params: Dict, result: Dict) -> Dict:
+    fields = await get_sentinel2(**params)
+    fields["previews"] = {"s2": await asyncio.to_thread(preview_folder, fields["folder"], "image")}
+    return fields
+
+async def job_sr(params: Dict, result: Dict) -> Dict:
+    sr = await get_sr(result["folder"])
+    return {"sr": sr, "previews": {"sr": await asyncio.to_thread(preview_folder, result["folder"], "sr")}}
+
+async def job_buildings(params: Dict, result: Dict) -> Dict:
+    return {"buildings": await get_buildings(result["folder"])}
+
+async def job_vis(params: Dict, result: Dict) -> Dict:
+    return {"vis": await get_vis(result["folder"])}
+
+JOB_STAGES = [
+    ("download", job_download),
+    ("sr", job_sr),
+    ("buildings", job_buildings),
+    ("vis", job_vis),
+]
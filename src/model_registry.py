@@ -0,0 +1,166 @@
+import os
+import time
+import logging
+import threading
+
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_rss() -> int:
+    """
+    Get the resident set size of the current process in bytes.
+
+    Returns:
+    - int: The resident memory in bytes (0 if it can not be read).
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_model_bytes(model: Any) -> int:
+    """
+    Get the size in bytes of the parameters and buffers of a torch model.
+
+    Args:
+    - model (Any): The loaded model.
+
+    Returns:
+    - int: The size in bytes (0 if the model does not expose parameters).
+    """
+    total = 0
+    for getter in ("parameters", "buffers"):
+        if hasattr(model, getter):
+            total += sum(t.numel() * t.element_size() for t in getattr(model, getter)())
+    return total
+
+
+class ModelRegistry:
+    """
+    Process-level registry that loads each model once and keeps it in memory.
+
+    Every gunicorn worker imports this module and owns its own registry, so
+    the models are loaded once per worker (at startup in the lifespan hook of
+    server.py) and shared by all the requests served by that worker.
+    """
+
+    def __init__(self):
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._models: Dict[str, Any] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.RLock()
+
+    def register(self, name: str, loader: Callable[[], Any]) -> None:
+        """
+        Register a loader function for a model.
+
+        Args:
+        - name (str): The model name, e.g. 'sr' or 'building'.
+        - loader (Callable): Function without arguments returning the model.
+        """
+        with self._lock:
+            self._loaders[name] = loader
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._loaders)
+
+    def load(self, name: str) -> Any:
+        """
+        Load (or reload) a model and record its load time and memory.
+
+        Args:
+        - name (str): The model name.
+
+        Returns:
+        - Any: The loaded model.
+        """
+        if name not in self._loaders:
+            raise KeyError(f"Model '{name}' is not registered")
+
+        with self._lock:
+            # The previous instance keeps serving until the new one is loaded,
+            # and stays if the load fails
+            rss_before = get_rss()
+            start = time.perf_counter()
+            model = self._loaders[name]()
+            load_time = time.perf_counter() - start
+            rss_after = get_rss()
+
+            self._models[name] = model
+            self._stats[name] = {
+                "load_time_s": round(load_time, 3),
+                "rss_delta_bytes": max(rss_after - rss_before, 0),
+                "param_bytes": get_model_bytes(model),
+                "loaded_at": time.time(),
+                "loads": self._stats.get(name, {}).get("loads", 0) + 1,
+            }
+            logger.info(f"Model '{name}' loaded in {load_time:.2f}s")
+            return model
+
+    def get(self, name: str) -> Any:
+        """
+        Get a model, loading it the first time it is requested.
+
+        Args:
+        - name (str): The model name.
+
+        Returns:
+        - Any: The loaded model.
+        """
+        model = self._models.get(name)
+        if model is None:
+            with self._lock:
+                model = self._models.get(name)
+                if model is None:
+                    model = self.load(name)
+        return model
+
+    def load_all(self) -> None:
+        """Load every registered model that is not loaded yet."""
+        for name in self.names:
+            self.get(name)
+
+    def reload(self, name: Optional[str] = None) -> List[str]:
+        """
+        Reload one model or all the registered models.
+
+        Args:
+        - name (str, optional): The model name. If None, reload all.
+
+        Returns:
+        - List[str]: The names of the reloaded models.
+        """
+        names = [name] if name is not None else self.names
+        for model_name in names:
+            if model_name not in self._loaders:
+                raise KeyError(f"Model '{model_name}' is not registered")
+        for model_name in names:
+            self.load(model_name)
+        return names
+
+    def clear(self) -> None:
+        """Release all the loaded models."""
+        with self._lock:
+            self._models.clear()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the load statistics of every registered model.
+
+        Returns:
+        - Dict[str, Dict[str, Any]]: The statistics per model name.
+        """
+        return {
+            name: {"loaded": name in self._models, **self._stats.get(name, {})}
+            for name in self.names
+        } | {"_process": {"pid": os.getpid(), "rss_bytes": get_rss()}}
+
+
+# Registry shared by the whole worker process
+registry = ModelRegistry()
@@ -1,9 +1,77 @@
+import os
+import json
+import uuid
+import asyncio
+from typing import Dict
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from planet import exceptions
 from basemodels import DownloadRequest, SearchRequest
-import methods
+from planet_sessions import get_pool
+import jobs
+import utils
+import logging
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Items per NDJSON page of the search results, and items searched at most
+PLANET_PAGE_SIZE = int(os.getenv("VHR_PLANET_PAGE_SIZE", "50"))
+PLANET_SEARCH_LIMIT = int(os.getenv("VHR_PLANET_SEARCH_LIMIT", "100"))
+# Root of the folders of the orders, the order_dir of a request is relative to it
+PLANET_ORDER_DIR = os.getenv("VHR_PLANET_ORDER_DIR", "/usr/src/app/data/planet")
+# Kind of the order jobs (see jobs.py)
+PLANET_ORDER = "planet_order"
+
+# API keys of the queued orders of this worker, by reference. They are only
+# kept in memory, so the jobs are bound to this worker
+_order_keys: Dict[str, str] = {}
+
+# Errors of the Planet API -> status code of the response
+PLANET_ERRORS = [
+    (exceptions.InvalidAPIKey, 401),
+    (exceptions.NoPermission, 403),
+    (exceptions.MissingResource, 404),
+    (exceptions.TooManyRequests, 429),
+    (exceptions.OverQuota, 429),
+    (exceptions.BadQuery, 400),
+    (exceptions.APIError, 502),
+    (exceptions.ClientError, 400),
+]
+
+def planet_error(e: Exception) -> HTTPException:
+    for error, status_code in PLANET_ERRORS:
+        if isinstance(e, error):
+            return HTTPException(status_code=status_code, detail=str(e))
+    return HTTPException(status_code=500, detail=str(e))
+
+def order_folder(order_dir: str) -> str:
+    """
+    Resolve the folder of an order under PLANET_ORDER_DIR.
+
+    Args:
+    - order_dir (str): The folder, relative to PLANET_ORDER_DIR.
+
+    Returns:
+    - str: The absolute folder.
+    """
+    root = os.path.realpath(PLANET_ORDER_DIR)
+    folder = os.path.realpath(os.path.join(root, order_dir))
+    if folder == root or os.path.commonpath([root, folder]) != root:
+        raise ValueError(f"The order folder '{order_dir}' must be a subfolder of the order root")
+    return folder
+
+async def search_pages(request: SearchRequest):
+    # The session is held until the last page is sent
+    sfilter = utils.create_filters(
+        request.geometry, request.edge_size, request.start_date, request.end_date, request.cloud_cover
+    )
+    async with get_pool().session(request.api_key) as session:
+        async for page in utils.query_data(
+            session, request.item_type, sfilter, request.asset, PLANET_PAGE_SIZE, PLANET_SEARCH_LIMIT
+        ):
+            yield page
+
 # POST THUMBNAILS FOR PLANET IMAGERY
 @router.post("/search")
 async def post_querydata(request: SearchRequest):
@@ -16,32 +84,102 @@ async def post_querydata(request: SearchRequest):
         - item_type (str): The item type to query
         - start_date (str): The start date for the query. Format: YYYY-MM-DD
         - end_date (str): The end date for the query. Format: YYYY-MM-DD
-        - cloud_cover (float): The cloud cover percentage 
+        - cloud_cover (float): The cloud cover percentage
         - asset (str): The asset to query. E.g. 'ortho_analytic_4b_sr'
-    """
+        - edge_size (int): The square searched around a point geometry
 
+    return:
+    - NDJSON, one line per page as the results arrive: {"page": n, "items":
+      {"Item_1": item, ...}}, or {"error": detail} if the search fails after
+      the first page.
+    """
+    pages = search_pages(request)
+    # The first page is awaited here, so a rejected key or query gets its status code
     try:
-        return await methods.query_datalist(**request.model_dump())
+        first = await pages.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-    
+        if isinstance(e, exceptions.InvalidAPIKey):
+            await get_pool().discard(request.api_key)
+        raise planet_error(e)
+
+    async def stream():
+        number = 0
+        try:
+            if first is not None:
+                yield json.dumps({"page": number, "items": first}) + "\n"
+                async for page in pages:
+                    number += 1
+                    yield json.dumps({"page": number, "items": page}) + "\n"
+        except Exception as e:
+            logger.error(f"Error in the Planet search: {e}", exc_info=True)
+            yield json.dumps({"error": str(e)}) + "\n"
+        finally:
+            await pages.aclose()
 
-# DOWNLOAD PLANET IMAGERY
-@router.post("/download_planet")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# DOWNLOAD PLANET IMAGERY (as a job, see jobs.py)
+async def job_order(params: Dict, result: Dict) -> Dict:
+    api_key = _order_keys.pop(params["key_ref"], None)
+    if api_key is None:
+        raise RuntimeError("The API key of the order is gone, submit it again")
+    try:
+        async with get_pool().session(api_key) as session:
+            order_id = await utils.create_and_download(session.client("orders"), params["order"], params["folder"])
+    except exceptions.InvalidAPIKey:
+        await get_pool().discard(api_key)
+        raise
+    return {"order_id": order_id, "folder": params["folder"]}
+
+JOB_STAGES = [
+    ("order", job_order),
+]
+
+@router.post("/download")
 async def download_planet(request: DownloadRequest):
     """
-    This function is used to create and download order for Planet Imagery
-    
+    This function is used to queue an order for Planet Imagery, that is
+    created, waited for and downloaded by a job of this worker.
+
     Args for request (DownloadRequest): The request model as defined in basemodels.py:
     - api_key (str): The API key for the planet API
     - item_type (str): The item type to query
-    - item_list (str): Get the ID list from items
+    - item_list (str): Get the ID list from items, separated by commas
     - geometry (str): The geometry in string format
-    - order_dir (str): The directory to save the downloaded files
+    - order_dir (str): The folder to save the downloaded files, relative to PLANET_ORDER_DIR
     - product_bundle (str): The product bundle to download
+    - edge_size (int): The square ordered around a point geometry
+
+    return:
+    - The job id, to poll /sentinel2/jobs/{job_id}. The result of the job
+      has the order_id and the folder with the downloaded files.
     """
+    item_list = [item.strip() for item in request.item_list.split(",") if item.strip()]
+    try:
+        if not item_list:
+            raise ValueError("No items to order")
+        folder = order_folder(request.order_dir)
+        order = utils.create_request(
+            request.item_type, item_list, request.geometry, request.edge_size, request.product_bundle
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    # The key is not written to the jobs database
+    key_ref = uuid.uuid4().hex
+    _order_keys[key_ref] = request.api_key
+    params = {"order": order, "folder": folder, "key_ref": key_ref}
     try:
-        return await methods.create_download(**request.model_dump())
+        job_id = await asyncio.to_thread(
+            jobs.get_store().submit, params, PLANET_ORDER, [name for name, _ in JOB_STAGES], jobs.worker_id()
+        )
     except Exception as e:
+        _order_keys.pop(key_ref, None)
+        logger.error(f"Error in download_planet: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
+    return {"job_id": job_id, "status": jobs.QUEUED}
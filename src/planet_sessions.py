@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import contextlib
+
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import planet
+
+from utils import get_auth
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept open per worker, and seconds an unused session is kept
+PLANET_MAX_SESSIONS = int(os.getenv("VHR_PLANET_MAX_SESSIONS", "32"))
+PLANET_SESSION_IDLE = float(os.getenv("VHR_PLANET_SESSION_IDLE", "1800"))
+
+
+class _Entry:
+    def __init__(self, session: planet.Session):
+        self.session = session
+        self.users = 0
+        self.last_used = time.monotonic()
+        # Closed by the last user once it is out of the pool
+        self.retired = False
+
+
+class SessionPool:
+    """
+    Long-lived planet.Session objects of one worker, one per API key.
+
+    A session keeps its HTTP connections (and the SDK rate limiter) open
+    between requests, and the key is only kept in memory: nothing is
+    written to ~/.planet.json. Sessions unused for PLANET_SESSION_IDLE
+    seconds, or the least recently used ones over PLANET_MAX_SESSIONS, are
+    closed once no request is using them.
+    """
+
+    def __init__(self, max_sessions: int = PLANET_MAX_SESSIONS, idle: float = PLANET_SESSION_IDLE):
+        self.max_sessions = max_sessions
+        self.idle = idle
+        self._sessions: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = asyncio.Lock()
+        self.created = 0
+
+    @staticmethod
+    def _key(api_key: str) -> str:
+        return hashlib.sha256(api_key.encode()).hexdigest()
+
+    def _retire(self, key: str) -> List[planet.Session]:
+        # Take a session out of the pool, get it back if it can be closed now
+        entry = self._sessions.pop(key)
+        entry.retired = True
+        return [entry.session] if entry.users == 0 else []
+
+    @contextlib.asynccontextmanager
+    async def session(self, api_key: str) -> AsyncIterator[planet.Session]:
+        """
+        Use the session of an API key, opening it the first time.
+
+        Args:
+        - api_key (str): The API key for the planet API.
+
+        Yields:
+        - planet.Session: The session, open until the block exits.
+        """
+        key = self._key(api_key)
+        to_close = []
+        async with self._lock:
+            now = time.monotonic()
+            for other, idle_entry in list(self._sessions.items()):
+                if other != key and idle_entry.users == 0 and now - idle_entry.last_used > self.idle:
+                    to_close += self._retire(other)
+            entry = self._sessions.get(key)
+            if entry is None:
+                entry = _Entry(planet.Session(auth=get_auth(api_key)))
+                self._sessions[key] = entry
+                self.created += 1
+                # Sessions in use are closed by their last user
+                for other in list(self._sessions)[:-1]:
+                    if len(self._sessions) <= self.max_sessions:
+                        break
+                    to_close += self._retire(other)
+            self._sessions.move_to_end(key)
+            entry.users += 1
+        await self._close(to_close)
+
+        try:
+            yield entry.session
+        finally:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            if entry.retired and entry.users == 0:
+                await self._close([entry.session])
+
+    async def discard(self, api_key: str) -> None:
+        """Drop the session of an API key (e.g. a rejected key)."""
+        async with self._lock:
+            key = self._key(api_key)
+            to_close = self._retire(key) if key in self._sessions else []
+        await self._close(to_close)
+
+    async def _close(self, sessions: List[planet.Session]) -> None:
+        for session in sessions:
+            try:
+                await session.aclose()
+            except Exception as e:
+                logger.warning(f"Error closing a Planet session: {e}")
+
+    async def close(self) -> None:
+        """Close all the sessions (at the shutdown of the worker)."""
+        async with self._lock:
+            sessions = []
+            for key in list(self._sessions):
+                sessions += self._retire(key)
+        await self._close(sessions)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "in_use": sum(entry.users > 0 for entry in self._sessions.values()),
+            "created": self.created,
+            "max_sessions": self.max_sessions,
+        }
+
+
+_pool: Optional[SessionPool] = None
+
+
+def get_pool() -> SessionPool:
+    """Get the session pool of this worker, creating it the first time."""
+    global _pool
+    if _pool is None:
+        _pool = SessionPool()
+    return _pool
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+import contextlib
+import numpy as np
+import rasterio as rio
+
+from typing import Any, Dict, Iterator, List, Optional
+from rasterio.transform import from_bounds
+
+# Root of the job folders and of the AOI workspaces
+OUTPUT_DIR = os.getenv("VHR_OUTPUT_DIR", "/usr/src/app/public/output")
+
+# Manifest of an output folder: the folder metadata (CRS and bbox of the AOI,
+# output format, stretch...) and every product with its kind, date, dtype,
+# shape, CRS and checksum. The stages select their inputs from it
+MANIFEST_FILE = "manifest.json"
+# Folders written before the manifest only have the metadata
+LEGACY_METADATA_FILE = "metadata.json"
+PRODUCT_EXTENSIONS = (".npy", ".tif")
+# Open the .npy products memory-mapped (read only): the stages then only keep
+# in memory the batch they are working on
+PRODUCT_MMAP = os.getenv("VHR_MMAP", "1") == "1"
+
+# How each product is stored as a COG: dtype and scale to get back the values
+# the pipeline works with (S2 in reflectance x 10000, SR in reflectance 0-1,
+# building masks in 0/1)
+COG_ENCODING = {
+    "image": {"dtype": "uint16", "scale": 1.0, "nodata": 0},
+    "sr": {"dtype": "uint16", "scale": 1e-4, "nodata": None},
+    "build": {"dtype": "uint8", "scale": 1.0, "nodata": None},
+}
+
+
+def output_folder(folder: str) -> str:
+    """
+    Resolve a folder sent by a client: a job folder or AOI workspace under
+    OUTPUT_DIR, given by its path or by its name.
+
+    Returns:
+    - str: The path of the folder under OUTPUT_DIR.
+
+    Raises:
+    - ValueError: If the folder is not under OUTPUT_DIR.
+    """
+    root = os.path.realpath(OUTPUT_DIR)
+    path = os.path.realpath(os.path.join(OUTPUT_DIR, folder))
+    if path == root or os.path.commonpath([root, path]) != root:
+        raise ValueError(f"The folder '{folder}' is not an output folder")
+    # The path the folder was registered with (see artifact_store)
+    return os.path.join(OUTPUT_DIR, os.path.relpath(path, root))
+
+
+@contextlib.contextmanager
+def _manifest_lock(folder: str) -> Iterator[None]:
+    # flock: exclusive between the threads and the processes of all the workers
+    with open(os.path.join(folder, ".manifest.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _legacy_manifest(folder: str) -> Dict[str, Any]:
+    metadata = {}
+    legacy_path = os.path.join(folder, LEGACY_METADATA_FILE)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r") as file:
+            metadata = json.load(file)
+
+    products = {}
+    for name in sorted(os.listdir(folder)):
+        stem, extension = os.path.splitext(name)
+        if extension in PRODUCT_EXTENSIONS and "_" in stem:
+            kind, date_eval = stem.rsplit("_", 1)
+            products[name] = {
+                "kind": kind,
+                "date": date_eval,
+                "path": name,
+                "format": "npy" if extension == ".npy" else "cog",
+            }
+    return {"metadata": metadata, "products": products}
+
+
+def read_manifest(folder: str) -> Dict[str, Any]:
+    """
+    Read the manifest of an output folder.
+
+    Returns:
+    - Dict[str, Any]: "metadata" and "products" (by file name).
+    """
+    path = os.path.join(folder, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return _legacy_manifest(folder)
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def update_manifest(
+    folder: str,
+    metadata: Optional[Dict[str, Any]] = None,
+    products: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Any]:
+    """
+    Merge metadata fields and product entries into the manifest of a folder.
+    The read-modify-write is locked and the file is replaced atomically, so
+    concurrent stages never lose an entry and readers never see a partial file.
+
+    Returns:
+    - Dict[str, Any]: The updated manifest.
+    """
+    with _manifest_lock(folder):
+        manifest = read_manifest(folder)
+        manifest["metadata"].update(metadata or {})
+        manifest["products"].update(products or {})
+        manifest["updated"] = time.time()
+        tmp_path = os.path.join(folder, f".{MANIFEST_FILE}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(tmp_path, os.path.join(folder, MANIFEST_FILE))
+    return manifest
+
+
+def write_metadata(folder: str, **fields) -> Dict[str, Any]:
+    """
+    Merge the given fields into the metadata of an output folder.
+
+    Returns:
+    - Dict[str, Any]: The updated metadata.
+    """
+    return update_manifest(folder, metadata=fields)["metadata"]
+
+
+def read_metadata(folder: str) -> Dict[str, Any]:
+    return read_manifest(folder)["metadata"]
+
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 ** 2), b""):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def register_product(folder: str, kind: str, date_eval: str, path: str, **fields) -> Dict[str, Any]:
+    """
+    Add a file written in a folder to its manifest, with its size and checksum.
+
+    Args:
+    - folder (str): The output folder.
+    - kind (str): The product kind (image, sr, build, render_combined...).
+    - date_eval (str): The date of the product.
+    - path (str): The path of the file.
+    - **fields: Other fields of the entry (format, dtype, shape, crs...).
+
+    Returns:
+    - Dict[str, Any]: The entry.
+    """
+    entry = {
+        "kind": kind,
+        "date": date_eval,
+        "path": os.path.basename(path),
+        "bytes": os.path.getsize(path),
+        "checksum": file_checksum(path),
+        "created": time.time(),
+        **fields,
+    }
+    update_manifest(folder, products={entry["path"]: entry})
+    return entry
+
+
+def product_paths(folder: str, kind: str) -> Dict[str, str]:
+    """
+    Get the products of a kind in a folder from its manifest.
+
+    Returns:
+    - Dict[str, str]: The path of the product of each date, sorted by date.
+    """
+    products = [p for p in read_manifest(folder)["products"].values() if p["kind"] == kind]
+    paths = {}
+    for product in sorted(products, key=lambda p: (p["date"], p.get("created", 0))):
+        path = os.path.join(folder, product["path"])
+        if os.path.exists(path):
+            paths[product["date"]] = path
+    return paths
+
+
+def list_products(folder: str, prefix: str) -> List[str]:
+    """
+    List the stored products of a kind (image, sr or build) in a folder.
+
+    Returns:
+    - List[str]: The paths, sorted by date.
+    """
+    return list(product_paths(folder, prefix).values())
+
+
+def product_date(path: str) -> str:
+    """Date of a product from its name, e.g. sr_2024-09-07.tif -> 2024-09-07 (prefer product_paths)."""
+    return os.path.splitext(os.path.basename(path))[0].split("_")[-1]
+
+
+def write_product(
+    folder: str,
+    prefix: str,
+    date_eval: str,
+    array: np.ndarray,
+    output_format: Optional[str] = None,
+) -> str:
+    """
+    Write a product as .npy or as a georeferenced, compressed COG.
+
+    For COGs the transform comes from the AOI bbox of the folder metadata and
+    the shape of the array, so the 10 m S2 and the 2.5 m SR and masks share
+    the same extent.
+
+    Args:
+    - folder (str): The output folder.
+    - prefix (str): The product kind: image, sr or build.
+    - date_eval (str): The date of the product.
+    - array (np.ndarray): The product, (bands, height, width) or (height, width).
+    - output_format (str, optional): "npy" or "cog". Defaults to the format
+      of the folder metadata.
+
+    Returns:
+    - str: The path of the product.
+    """
+    metadata = read_metadata(folder)
+    output_format = output_format or metadata.get("format", "npy")
+
+    crs = f"EPSG:{metadata['epsg']}" if "epsg" in metadata else None
+    if output_format == "npy":
+        path = os.path.join(folder, f"{prefix}_{date_eval}.npy")
+        # Written to a temporary file and renamed: a reader that has the old
+        # product memory-mapped keeps its (unlinked) file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, array)
+        os.replace(tmp_path, path)
+        register_product(
+            folder, prefix, date_eval, path,
+            format="npy", dtype=str(array.dtype), shape=list(array.shape), crs=crs,
+        )
+        return path
+    if output_format != "cog":
+        raise ValueError(f"Unknown output format '{output_format}', use 'npy' or 'cog'")
+
+    encoding = COG_ENCODING[prefix]
+    data = array[None] if array.ndim == 2 else array
+    count, height, width = data.shape
+
+    info = np.iinfo(encoding["dtype"])
+    data = np.nan_to_num(data / encoding["scale"], nan=encoding["nodata"] or 0)
+    data = np.rint(data).clip(info.min, info.max).astype(encoding["dtype"])
+
+    path = os.path.join(folder, f"{prefix}_{date_eval}.tif")
+    profile = {
+        "driver": "COG",
+        "count": count,
+        "height": height,
+        "width": width,
+        "dtype": encoding["dtype"],
+        "crs": crs,
+        "transform": from_bounds(*metadata["bbox"], width, height),
+        "nodata": encoding["nodata"],
+        "compress": "DEFLATE",
+        "predictor": "YES",
+        "blocksize": 256,
+        "overview_resampling": "NEAREST" if prefix == "build" else "AVERAGE",
+    }
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with rio.open(tmp_path, "w", **profile) as dst:
+        dst.write(data)
+        dst.scales = [encoding["scale"]] * count
+    os.replace(tmp_path, path)
+    register_product(
+        folder, prefix, date_eval, path,
+        format="cog", dtype=encoding["dtype"], shape=list(array.shape), crs=crs, scale=encoding["scale"],
+    )
+    return path
+
+
+def read_product(path: str, mmap: Optional[bool] = None) -> np.ndarray:
+    """
+    Read a product written by write_product, back in the pipeline units.
+
+    Args:
+    - path (str): The path of the product.
+    - mmap (bool, optional): Memory-map .npy products (read only). Defaults
+      to PRODUCT_MMAP. COGs are compressed and always read.
+
+    Returns:
+    - np.ndarray: The product (bands, height, width); masks are (height, width).
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r" if (PRODUCT_MMAP if mmap is None else mmap) else None)
+
+    with rio.open(path) as src:
+        scale = src.scales[0]
+        # Read straight into float32 and scale in place: a single copy
+        data = src.read(out_dtype="float32") if scale != 1 else src.read()
+    if scale != 1:
+        data *= np.float32(scale)
+    return data[0] if data.shape[0] == 1 else data
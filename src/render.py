@@ -0,0 +1,172 @@
+import os
+import numpy as np
+
+from typing import Callable, Dict, List
+from PIL import Image
+
+from raster_io import read_metadata, write_metadata
+
+# Contrast stretch of the RGB renders, computed once per time series so every
+# date (and the S2 and SR of a date) share the same colors:
+# - "percentile": linear per band between the RENDER_PERCENTILES
+# - "equalize": histogram equalization LUT over the reflectance of all bands
+RENDER_STRETCH = os.getenv("VHR_RENDER_STRETCH", "percentile")
+RENDER_PERCENTILES = (2, 98)
+EQUALIZE_BINS = 1024
+EQUALIZE_MAX = 0.3  # Reflectance of the last bin (the old x3 clip)
+STRETCH_SAMPLE_PIXELS = 1_000_000
+
+# Encoding of the renders: "png" or "webp"
+RENDER_FORMAT = os.getenv("VHR_RENDER_FORMAT", "png").lower()
+RENDER_PNG_LEVEL = int(os.getenv("VHR_RENDER_PNG_LEVEL", "1"))
+RENDER_WEBP_QUALITY = int(os.getenv("VHR_RENDER_WEBP_QUALITY", "90"))
+IMAGE_EXTENSION = f".{RENDER_FORMAT}"
+
+# Gap between the panels of the composite, in pixels
+COMPOSITE_GAP = 8
+
+
+def compute_stretch(images: List[np.ndarray], mode: str = RENDER_STRETCH) -> Dict:
+    """
+    Compute the contrast stretch of a time series from a sample of its pixels.
+
+    Args:
+    - images (List[np.ndarray]): The S2 scenes (bands, H, W) in reflectance x 10000.
+      The first three bands are rendered as RGB. NaN (outside the footprint of
+      the scenes) is left out.
+    - mode (str): "percentile" or "equalize".
+
+    Returns:
+    - Dict: The stretch, JSON serializable (it is kept in the folder metadata).
+    """
+    if not images:
+        return {"mode": "percentile", "low": [0.0] * 3, "high": [EQUALIZE_MAX] * 3}
+
+    # Strided sample of every scene, about STRETCH_SAMPLE_PIXELS in total
+    total = sum(image[0].size for image in images)
+    step = max(1, total // STRETCH_SAMPLE_PIXELS)
+    sample = np.concatenate(
+        [np.asarray(image[0:3]).reshape(3, -1)[:, ::step] for image in images], axis=1
+    ).astype(np.float32) / 10000
+
+    finite = np.isfinite(sample)
+    if mode == "percentile":
+        low, high = np.zeros(3), np.full(3, EQUALIZE_MAX)
+        for b in range(3):
+            if finite[b].any():
+                low[b], high[b] = np.percentile(sample[b][finite[b]], RENDER_PERCENTILES)
+        return {"mode": "percentile", "low": low.tolist(), "high": np.maximum(high, low + 1e-4).tolist()}
+    if mode == "equalize":
+        hist, _ = np.histogram(sample[finite], bins=EQUALIZE_BINS, range=(0, EQUALIZE_MAX))
+        cdf = np.cumsum(hist) / max(1, hist.sum())
+        return {"mode": "equalize", "max": EQUALIZE_MAX, "lut": np.round(cdf * 255).astype(int).tolist()}
+    raise ValueError(f"Unknown stretch '{mode}', use 'percentile' or 'equalize'")
+
+
+def folder_stretch(folder: str, images: Callable[[], List[np.ndarray]]) -> Dict:
+    """
+    Get the stretch of a folder, computing it the first time from the S2
+    scenes returned by images(). It is kept in the metadata, so the dates
+    rendered later (e.g. in a workspace) keep the same colors.
+    """
+    stretch = read_metadata(folder).get("stretch")
+    # A NaN stretch (computed before the footprints were masked) is computed again
+    if stretch is None or not np.isfinite(stretch.get("low", [])).all():
+        stretch = compute_stretch(images())
+        write_metadata(folder, stretch=stretch)
+    return stretch
+
+
+def apply_stretch(image: np.ndarray, stretch: Dict, scale: float = 1.0) -> np.ndarray:
+    """
+    Render the first three bands of an image as uint8 RGB with a stretch.
+
+    Args:
+    - image (np.ndarray): The image (bands, H, W).
+    - stretch (Dict): The stretch (see compute_stretch).
+    - scale (float): Factor to get reflectance from the values (1e-4 for S2).
+
+    Returns:
+    - np.ndarray: The (H, W, 3) uint8 image. NaN pixels are black.
+    """
+    height, width = image.shape[1:]
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    band = np.empty((height, width), dtype=np.float32)
+    # Only float images have NaN (outside the footprint of the scenes)
+    masked = np.issubdtype(image.dtype, np.floating)
+    invalid = np.empty((height, width), dtype=bool) if masked else None
+
+    for b in range(3):
+        if stretch["mode"] == "equalize":
+            lut = np.asarray(stretch["lut"], dtype=np.uint8)
+            bins = len(lut)
+            np.multiply(image[b], scale * bins / stretch["max"], out=band, casting="unsafe")
+            if masked:
+                np.logical_not(np.isfinite(band), out=invalid)
+                band[invalid] = 0
+            np.clip(band, 0, bins - 1, out=band)
+            out[..., b] = lut[band.astype(np.intp)]
+        else:
+            low, high = stretch["low"][b], stretch["high"][b]
+            gain = 255 / (high - low)
+            # One fused pass per band: scale, shift, clip and cast
+            np.multiply(image[b], scale * gain, out=band, casting="unsafe")
+            band -= low * gain
+            if masked:
+                np.logical_not(np.isfinite(band), out=invalid)
+                band[invalid] = 0
+            np.clip(band, 0, 255, out=band)
+            out[..., b] = band
+        if masked:
+            out[..., b][invalid] = 0
+    return out
+
+
+def mask_to_gray(mask: np.ndarray) -> np.ndarray:
+    """Render a 0/1 mask as a (H, W) uint8 image, buildings in white."""
+    return np.where(mask > 0, np.uint8(255), np.uint8(0))
+
+
+def composite(panels: List[np.ndarray]) -> np.ndarray:
+    """
+    Put RGB or gray panels side by side, at the resolution of the largest one.
+    Smaller panels are upsampled by pixel repetition (nearest neighbour).
+
+    Returns:
+    - np.ndarray: The (H, W, 3) uint8 composite.
+    """
+    height = max(panel.shape[0] for panel in panels)
+    gap = np.full((height, COMPOSITE_GAP, 3), 255, dtype=np.uint8)
+
+    row = []
+    for panel in panels:
+        if panel.ndim == 2:
+            panel = np.repeat(panel[..., None], 3, axis=2)
+        factor = height // panel.shape[0]
+        if factor > 1:
+            panel = panel.repeat(factor, axis=0).repeat(factor, axis=1)
+        if panel.shape[0] != height:
+            width = round(panel.shape[1] * height / panel.shape[0])
+            panel = np.asarray(Image.fromarray(panel).resize((width, height), Image.NEAREST))
+        row += [panel, gap]
+    return np.concatenate(row[:-1], axis=1)
+
+
+def save_image(array: np.ndarray, path: str) -> str:
+    """
+    Encode a uint8 (H, W) or (H, W, 3) array at native resolution.
+
+    Args:
+    - array (np.ndarray): The image.
+    - path (str): The path without extension (IMAGE_EXTENSION is added).
+
+    Returns:
+    - str: The path of the file.
+    """
+    path = f"{path}{IMAGE_EXTENSION}"
+    image = Image.fromarray(array)
+    if RENDER_FORMAT == "webp":
+        image.save(path, format="WEBP", quality=RENDER_WEBP_QUALITY, method=4)
+    else:
+        image.save(path, format="PNG", compress_level=RENDER_PNG_LEVEL)
+    return path
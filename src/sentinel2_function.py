@@ -1,11 +1,35 @@
-from fastapi import APIRouter, HTTPException
-from basemodels import DownloadRequest, SearchRequest, SearchRequestS2, SuperResolution
+import json
+import asyncio
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
+from basemodels import DownloadRequest, SearchRequest, SearchRequestS2, SuperResolution, PipelineRequest, FootprintsRequest, TimelapseRequest
+from model_registry import registry
+import executor
 import methods
+import jobs
+import timelapse
+from chip_cache import get_cache
+from raster_io import output_folder
 import logging
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Polling interval and keep-alive period of the job event streams, in seconds
+SSE_POLL_INTERVAL = 0.5
+SSE_KEEPALIVE = 15.0
+
+def request_folder(folder: str) -> str:
+    # The folders of the requests must be output folders (see raster_io.output_folder)
+    try:
+        return output_folder(folder)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def get_model(name: str):
+    # The process pool uses its own warm models, nothing to hand over
+    return registry.get(name) if executor.shares_models() else None
+
 # DOWNLOAD S2 CUBO
 @router.post("/download_s2")
 async def download_s2(request: SearchRequestS2):
@@ -19,9 +43,15 @@ async def download_s2(request: SearchRequestS2):
     - fechas (str): Dates.
     - edge_size (int): The edge size.
     - path (str): Output path.
+    - selection (str): "all" scenes in the window, or only the best ones by
+      "metadata" (eo:cloud_cover) or "scl" (cloud fraction over the AOI).
+    - max_scenes (int): Scenes kept per date when selection is not "all".
+    - output_format (str): "npy" or "cog" (tiled, compressed and georeferenced
+      GeoTIFFs: uint16 S2 and SR, uint8 building masks).
 
     return:
-    - The path to the downloaded files.
+    - folder: The path to the downloaded files.
+    - dates: The status of each requested date, with its scenes or error.
     """
 
     try:
@@ -39,9 +69,10 @@ async def sr_s2(request: SuperResolution):
     Args:
         request (_type_): _description_
     """
+    folder = request_folder(request.folder)
     try:
         logger.info(f"Request received: {request}")
-        return await methods.get_sr(**request.model_dump())
+        return await methods.get_sr(**{**request.model_dump(), "folder": folder}, model=get_model("sr"))
     except Exception as e:
         logger.error(f"Error in sr_s2: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -54,9 +85,10 @@ async def get_buildings(request: SuperResolution):
     Args:
         request (_type_): _description_
     """
+    folder = request_folder(request.folder)
     try:
         logger.info(f"Request received: {request}")
-        return await methods.get_buildings(**request.model_dump())
+        return await methods.get_buildings(**{**request.model_dump(), "folder": folder}, model=get_model("building"))
     except Exception as e:
         logger.error(f"Error in get_buildings: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -69,10 +101,239 @@ async def get_vis(request: SuperResolution):
     Args:
         request (_type_): _description_
     """
+    folder = request_folder(request.folder)
     try:
         logger.info(f"Request received: {request}")
-        return await methods.get_vis(**request.model_dump())
+        return await methods.get_vis(**{**request.model_dump(), "folder": folder})
     except Exception as e:
         logger.error(f"Error in get_vis: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
-    
\ No newline at end of file
+    
+# BUILDING FOOTPRINTS AS VECTORS
+@router.post("/get_footprints")
+async def get_footprints(request: FootprintsRequest):
+    """
+    Vectorize the building masks of a folder into simplified polygons, with
+    the date and area (m2) of each building.
+
+    Args for request (FootprintsRequest):
+    - folder (str): The output folder of the job.
+    - dates (List[str], optional): Only these dates.
+    - simplify (float): Simplification tolerance in meters.
+    - min_area (float): Minimum building area in m2.
+    - bbox (List[float], optional): WGS84 [minx, miny, maxx, maxy] filter.
+    - crs (str): "wgs84" or "scene" (UTM of the scene).
+    - output (str): "geojson" or "geoparquet".
+
+    return:
+    - A GeoJSON FeatureCollection, or a GeoParquet file.
+    """
+    folder = request_folder(request.folder)
+    try:
+        logger.info(f"Request received: {request}")
+        result = await methods.get_footprints(**{**request.model_dump(), "folder": folder})
+        if isinstance(result, bytes):
+            return Response(content=result, media_type="application/vnd.apache.parquet")
+        return result
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in get_footprints: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# TIME-LAPSE OF A FOLDER
+@router.post("/timelapse")
+async def get_timelapse(request: TimelapseRequest):
+    """
+    Stream a time-lapse of the dates of a folder, encoded by ffmpeg while the
+    frames are rendered, with the same contrast stretch for every frame.
+
+    Args for request (TimelapseRequest):
+    - folder (str): The output folder of the job or AOI workspace.
+    - product (str): "s2", "sr", "build" or "combined".
+    - output_format (str): "mp4" or "webp" (animated).
+    - fps (float): Dates per second.
+    - max_size (int): Maximum side of the frames in pixels.
+    - dates (List[str], optional): Only these dates.
+
+    return:
+    - The video, streamed.
+    """
+    logger.info(f"Request received: {request}")
+    folder = request_folder(request.folder)
+    try:
+        if request.output_format not in timelapse.FORMATS:
+            raise ValueError(f"Unknown format '{request.output_format}', use one of {list(timelapse.FORMATS)}")
+        timelapse.timelapse_dates(folder, request.product, request.dates)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    return StreamingResponse(
+        timelapse.stream_timelapse(**{**request.model_dump(), "folder": folder}),
+        media_type=timelapse.FORMATS[request.output_format],
+        headers={"Content-Disposition": f'inline; filename="timelapse_{request.product}.{request.output_format}"'},
+    )
+
+# FUSED PIPELINE (download -> sr -> buildings -> PNG, in memory)
+@router.post("/pipeline")
+async def pipeline(request: PipelineRequest):
+    """
+    Run the whole Sentinel-2 pipeline in one request, passing the arrays
+    between the stages in memory instead of through .npy files.
+
+    Args for request (PipelineRequest): Same parameters as /download_s2, plus:
+    - save_intermediates (bool): Also write the image, sr and build .npy files.
+
+    return:
+    - The output folder and the products by date.
+    """
+    try:
+        logger.info(f"Request received: {request}")
+        return await methods.get_pipeline(
+            **request.model_dump(), sr_model=get_model("sr"), build_model=get_model("building")
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in pipeline: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# INCREMENTAL TIME SERIES OF AN AOI
+@router.post("/workspace")
+async def workspace(request: SearchRequestS2):
+    """
+    Run the whole Sentinel-2 pipeline in the persistent workspace of the AOI
+    (snapped bbox and parameters). The dates already processed are reused,
+    so adding a date to a time series only computes that date.
+
+    Args for request (SearchRequestS2): Same parameters as /download_s2.
+
+    return:
+    - folder: The workspace folder.
+    - new_dates: The dates computed by this request.
+    - dates: The status of each requested date, with its scenes or error.
+    - products: The products by scene date.
+    - changes: Built-up area added/removed (m2) and IoU between consecutive dates.
+    """
+    try:
+        logger.info(f"Request received: {request}")
+        return await methods.get_workspace(
+            **request.model_dump(), sr_model=get_model("sr"), build_model=get_model("building")
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in workspace: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# CHIP CACHE STATS
+@router.get("/cache")
+async def cache_stats():
+    """
+    Get the usage and hit/miss counters of the Sentinel-2 chip cache.
+    """
+    cache = get_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+# SUBMIT AN ASYNCHRONOUS S2 JOB (download -> sr -> buildings -> vis)
+@router.post("/jobs")
+async def submit_job(request: SearchRequestS2):
+    """
+    Queue the whole Sentinel-2 pipeline and return immediately.
+
+    Args for request (SearchRequestS2): Same parameters as /download_s2.
+
+    return:
+    - The job id, to poll /jobs/{job_id} and get /jobs/{job_id}/result.
+    """
+    try:
+        logger.info(f"Job received: {request}")
+        job_id = await asyncio.to_thread(jobs.get_store().submit, request.model_dump())
+        return {"job_id": job_id, "status": jobs.QUEUED}
+    except Exception as e:
+        logger.error(f"Error in submit_job: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+# STATUS OF A JOB
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Get the status of a job, with the state and timings of every stage.
+    """
+    job = await asyncio.to_thread(jobs.get_store().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stages": job["stages"],
+        "error": job["error"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+    }
+
+# RESULT OF A JOB
+@router.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """
+    Get the products of a finished job.
+    """
+    job = await asyncio.to_thread(jobs.get_store().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    if job["status"] == jobs.FAILED:
+        raise HTTPException(status_code=500, detail=job["error"])
+    if job["status"] != jobs.DONE:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+    return job["result"]
+
+# PROGRESS EVENTS OF A JOB (server-sent events)
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, request: Request):
+    """
+    Stream the progress of a job as server-sent events, so the client can
+    show the previews as soon as they exist:
+    - stage: a stage is running, done (with its result) or failed.
+    - preview: quicklooks of the S2 chips after the download, then the
+      subsampled SR, before the full products of the last stage.
+    - job: the job is done or failed (last event).
+
+    A reconnecting client resumes after its Last-Event-ID.
+    """
+    store = jobs.get_store()
+    if await asyncio.to_thread(store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    try:
+        last_id = int(request.headers.get("last-event-id", "0"))
+    except ValueError:
+        last_id = 0
+
+    async def stream():
+        nonlocal last_id
+        idle = 0.0
+        while not await request.is_disconnected():
+            # Read the status first, so no event published before the end is lost
+            job = await asyncio.to_thread(store.get, job_id)
+            events = await asyncio.to_thread(store.events, job_id, last_id)
+            for event in events:
+                last_id = event["id"]
+                yield f"id: {event['id']}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+            if events:
+                idle = 0.0
+                continue
+            if job["status"] in (jobs.DONE, jobs.FAILED):
+                return
+            idle += SSE_POLL_INTERVAL
+            if idle >= SSE_KEEPALIVE:
+                idle = 0.0
+                yield ": keep-alive\n\n"
+            await asyncio.sleep(SSE_POLL_INTERVAL)
+
+    return StreamingResponse(
+        stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
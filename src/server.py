@@ -1,18 +1,59 @@
-from fastapi import FastAPI
+import os
+import asyncio
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Split the cores between the workers before numpy/torch are imported
+import threads
+threads.apply_env()
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
+from model_registry import registry
+import executor
+import methods
+import jobs
+import artifact_store
+import memory
 import sentinel2_function
+import planet_function
+import planet_sessions
+import tiles_function
 import uvicorn
-import os
-from dotenv import load_dotenv
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the models once per worker before serving requests, with the
+    # thread budget already applied. With the process executor the models
+    # live in the (warm) pool processes instead
+    threads.apply_runtime()
+    if executor.shares_models():
+        registry.load_all()
+    executor.warm_up()
+    # Run the queued Sentinel-2 jobs in the background of this worker
+    runner = jobs.JobRunner(
+        jobs.get_store(),
+        {jobs.SENTINEL2: methods.JOB_STAGES, planet_function.PLANET_ORDER: planet_function.JOB_STAGES},
+    )
+    runner.start()
+    # Keep the output folders under their quota (replaces the cron cleanup)
+    cleanup = asyncio.create_task(artifact_store.cleanup_loop(artifact_store.get_store()))
+    yield
+    cleanup.cancel()
+    await runner.stop()
+    # Close the Planet sessions (their HTTP connections) of this worker
+    await planet_sessions.get_pool().close()
+    executor.shutdown()
+    registry.clear()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Enable CORS
 app.add_middleware(
@@ -28,6 +69,8 @@ app.mount("/static", StaticFiles(directory="/usr/src/app", html=True), name="pub
 
 # Include router
 app.include_router(sentinel2_function.router, prefix="/sentinel2")
+app.include_router(tiles_function.router, prefix="/tiles")
+app.include_router(planet_function.router, prefix="/planet")
 
 # Endpoint to expose APP_HOST and other environment variables
 @app.get("/config")
@@ -37,6 +80,57 @@ async def get_config():
         "APP_PORT": 8000
     }
 
+# Endpoint to inspect the models loaded in this worker
+@app.get("/models")
+async def get_models():
+    return registry.stats()
+
+# Endpoint with the effective thread settings and the stage memory of this worker
+@app.get("/diagnostics")
+async def get_diagnostics():
+    return {
+        **threads.diagnostics(),
+        "executor": {"kind": executor.EXECUTOR_KIND, "workers": executor.EXECUTOR_WORKERS},
+        # Peak RSS of the stages run in this worker (thread executor only)
+        "memory": memory.stats(),
+        "planet_sessions": planet_sessions.get_pool().stats(),
+    }
+
+# Endpoint to reload one model (or all of them) from disk. With the process
+# executor the pool is recycled instead, so its processes load all the models again
+@app.post("/models/reload")
+async def reload_models(name: str = None):
+    try:
+        if executor.shares_models():
+            reloaded = await asyncio.to_thread(registry.reload, name)
+        else:
+            if name is not None and name not in registry.names:
+                raise KeyError(f"Model '{name}' is not registered")
+            await asyncio.to_thread(executor.recycle)
+            reloaded = registry.names
+        return {"reloaded": reloaded, "stats": registry.stats()}
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error reloading the models: {e}")
+
+# Endpoint with the usage of the output folders
+@app.get("/storage")
+async def get_storage():
+    return await asyncio.to_thread(artifact_store.get_store().stats)
+
+# Endpoint to protect an output folder from eviction (or release it)
+@app.post("/storage/pin")
+async def pin_folder(folder: str, pinned: bool = True):
+    if not await asyncio.to_thread(artifact_store.get_store().pin, folder, pinned):
+        raise HTTPException(status_code=404, detail=f"Folder {folder} not found")
+    return {"folder": folder, "pinned": pinned}
+
+# Endpoint to enforce the quota now
+@app.post("/storage/cleanup")
+async def cleanup_storage():
+    return {"evicted": await asyncio.to_thread(artifact_store.get_store().evict)}
+
 @app.middleware("http")
 async def log_requests(request, call_next):
     logger = logging.getLogger("uvicorn")
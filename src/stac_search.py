@@ -0,0 +1,256 @@
+import stackstac
+import numpy as np
+import pystac_client
+import planetary_computer as pc
+import xarray as xr
+
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+from pyproj import Transformer
+from pyproj.aoi import AreaOfInterest
+from pyproj.database import query_utm_crs_info
+
+STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+COLLECTION = "sentinel-2-l2a"
+
+
+def utm_bbox(lat: float, lon: float, edge_size: int, resolution: float = 10) -> Tuple[List[float], List[List[float]], int]:
+    """
+    Get the UTM bbox of a chip centered at a point, snapped to the pixel grid
+    (the same bbox cubo builds for units="px").
+
+    Args:
+    - lat (float): Latitude of the center.
+    - lon (float): Longitude of the center.
+    - edge_size (int): The edge size in pixels.
+    - resolution (float): The pixel size in meters.
+
+    Returns:
+    - List[float]: The bbox [W, S, E, N] in UTM.
+    - List[List[float]]: The bbox ring in lon/lat, for the STAC search.
+    - int: The EPSG code of the UTM zone.
+    """
+    utm_crs_list = query_utm_crs_info(
+        datum_name="WGS 84",
+        area_of_interest=AreaOfInterest(lon, lat, lon, lat),
+    )
+    epsg = int(utm_crs_list[0].code)
+
+    transformer = Transformer.from_crs("EPSG:4326", f"EPSG:{epsg}", always_xy=True)
+    inverse_transformer = Transformer.from_crs(f"EPSG:{epsg}", "EPSG:4326", always_xy=True)
+
+    E, N = [round(coord / resolution) * resolution for coord in transformer.transform(lon, lat)]
+    distance = edge_size * resolution / 2
+    bbox = [E - distance, N - distance, E + distance, N + distance]
+
+    W, S, E, N = bbox
+    ring = [list(inverse_transformer.transform(x, y)) for x, y in [(W, S), (E, S), (E, N), (W, N), (W, S)]]
+    return bbox, ring, epsg
+
+
+def date_window(fecha: str, days_delay: int) -> Tuple[datetime, datetime]:
+    """Window of +-days_delay around a date (YYYY-MM-DD)."""
+    fecha = datetime.strptime(fecha, "%Y-%m-%d")
+    return fecha - timedelta(days=days_delay), fecha + timedelta(days=days_delay)
+
+
+def window_closed(fecha: str, days_delay: int) -> bool:
+    """
+    Whether the window of a date is over, so a search of it will not find
+    new acquisitions (its last day is in the past).
+    """
+    return date_window(fecha, days_delay)[1] + timedelta(days=1) <= datetime.utcnow()
+
+
+def merge_windows(fechas: List[str], days_delay: int) -> List[Tuple[datetime, datetime]]:
+    """
+    Merge the windows of the requested dates into the minimal set of
+    non-overlapping time ranges.
+
+    Args:
+    - fechas (List[str]): The requested dates, format YYYY-MM-DD.
+    - days_delay (int): Half-width of the window around each date, in days.
+
+    Returns:
+    - List[Tuple[datetime, datetime]]: The merged ranges, sorted.
+    """
+    windows = sorted(date_window(fecha, days_delay) for fecha in fechas)
+    merged = []
+    for start, end in windows:
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def search_items(
+    ring: List[List[float]],
+    windows: List[Tuple[datetime, datetime]],
+    max_cloud_cover: float = 50,
+    collection: str = COLLECTION,
+    stac: str = STAC_URL,
+) -> List:
+    """
+    Search, in a single STAC query, the items over the AOI in any of the windows.
+
+    Args:
+    - ring (List[List[float]]): The AOI ring in lon/lat.
+    - windows (List[Tuple[datetime, datetime]]): The time ranges (see merge_windows).
+    - max_cloud_cover (float): Keep items with eo:cloud_cover below this value.
+    - collection (str): The STAC collection.
+    - stac (str): The STAC API url.
+
+    Returns:
+    - List[pystac.Item]: The items found, signed for Planetary Computer.
+    """
+    catalog = pystac_client.Client.open(stac, modifier=pc.sign_inplace)
+
+    # One CQL2 filter with every time range, instead of one search per range
+    intervals = [
+        {
+            "op": "t_intersects",
+            "args": [
+                {"property": "datetime"},
+                {"interval": [f"{start:%Y-%m-%d}T00:00:00Z", f"{end:%Y-%m-%d}T23:59:59Z"]},
+            ],
+        }
+        for start, end in windows
+    ]
+    cql_filter = {
+        "op": "and",
+        "args": [
+            {"op": "<", "args": [{"property": "eo:cloud_cover"}, max_cloud_cover]},
+            intervals[0] if len(intervals) == 1 else {"op": "or", "args": intervals},
+        ],
+    }
+
+    search = catalog.search(
+        collections=[collection],
+        intersects={"type": "Polygon", "coordinates": [ring]},
+        filter=cql_filter,
+        filter_lang="cql2-json",
+    )
+    return list(search.items())
+
+
+def item_date(item) -> str:
+    return item.datetime.strftime("%Y-%m-%d")
+
+
+def assign_items(items: List, fechas: List[str], days_delay: int) -> Dict[str, List]:
+    """
+    Assign each item to the requested dates whose window contains it. An
+    item can serve several dates when their windows overlap.
+
+    Returns:
+    - Dict[str, List[pystac.Item]]: The items of each requested date.
+    """
+    assigned = {fecha: [] for fecha in fechas}
+    for fecha in fechas:
+        start, end = date_window(fecha, days_delay)
+        for item in items:
+            if start.date() <= item.datetime.date() <= end.date():
+                assigned[fecha].append(item)
+    return assigned
+
+
+def stack_items(items: List, bands: List[str], bbox: List[float], epsg: int, resolution: float = 10) -> xr.DataArray:
+    """
+    Build a single lazy data cube (time, band, y, x) with all the items.
+
+    Returns:
+    - xr.DataArray: The cube, with the item ids in the 'id' coordinate.
+    """
+    return stackstac.stack(
+        items,
+        assets=bands,
+        resolution=resolution,
+        bounds=bbox,
+        epsg=epsg,
+    )
+
+
+# SCL classes that make a pixel unusable: no data, saturated, cloud shadow,
+# cloud medium/high probability and thin cirrus
+SCL_INVALID = [0, 1, 3, 8, 9, 10]
+
+
+def scl_cloud_fraction(items: List, bbox: List[float], epsg: int, resolution: float = 60) -> Dict[str, float]:
+    """
+    Cheap cloud estimate over the AOI only: read the SCL band at low
+    resolution and get the fraction of invalid pixels of each item.
+
+    Args:
+    - items (List[pystac.Item]): The candidate items.
+    - bbox (List[float]): The AOI bbox in UTM.
+    - epsg (int): The EPSG code of the bbox.
+    - resolution (float): The resolution of the read, in meters.
+
+    Returns:
+    - Dict[str, float]: The invalid fraction (0 to 1) by item id.
+    """
+    scl = stackstac.stack(items, assets=["SCL"], resolution=resolution, bounds=bbox, epsg=epsg)
+    values = scl.isel(band=0).to_numpy()
+    invalid = np.isin(values, SCL_INVALID) | np.isnan(values)
+    fractions = invalid.reshape(invalid.shape[0], -1).mean(axis=1)
+    return dict(zip(scl.id.values.tolist(), fractions.tolist()))
+
+
+def rank_by_metadata(items: List, fecha: str) -> List:
+    """
+    Rank the items of a date by eo:cloud_cover, then by distance to the date.
+    """
+    target = datetime.strptime(fecha, "%Y-%m-%d").date()
+    return sorted(
+        items,
+        key=lambda item: (
+            item.properties.get("eo:cloud_cover", 100),
+            abs((item.datetime.date() - target).days),
+        ),
+    )
+
+
+def select_items(
+    assigned: Dict[str, List],
+    selection: str,
+    max_scenes: int,
+    bbox: List[float],
+    epsg: int,
+    scl_candidates: int = 3,
+) -> Dict[str, List]:
+    """
+    Keep only the best scenes of each date.
+
+    Args:
+    - assigned (Dict[str, List]): The items of each date (see assign_items).
+    - selection (str): "all" keeps every item, "metadata" ranks them by
+      eo:cloud_cover, and "scl" reranks the best metadata candidates by the
+      cloud fraction of a low resolution SCL read over the AOI.
+    - max_scenes (int): The number of scenes kept per date.
+    - bbox (List[float]): The AOI bbox in UTM.
+    - epsg (int): The EPSG code of the bbox.
+    - scl_candidates (int): Candidates per kept scene read in "scl" mode.
+
+    Returns:
+    - Dict[str, List[pystac.Item]]: The selected items of each date.
+    """
+    if selection == "all":
+        return assigned
+    if selection not in ("metadata", "scl"):
+        raise ValueError(f"Unknown selection '{selection}', use 'all', 'metadata' or 'scl'")
+
+    ranked = {fecha: rank_by_metadata(items, fecha) for fecha, items in assigned.items()}
+    if selection == "metadata":
+        return {fecha: items[:max_scenes] for fecha, items in ranked.items()}
+
+    candidates = {fecha: items[:max_scenes * scl_candidates] for fecha, items in ranked.items()}
+    unique = {item.id: item for items in candidates.values() for item in items}
+    if not unique:
+        return candidates
+    fractions = scl_cloud_fraction(list(unique.values()), bbox, epsg)
+    return {
+        fecha: sorted(items, key=lambda item: fractions.get(item.id, 1.0))[:max_scenes]
+        for fecha, items in candidates.items()
+    }
@@ -0,0 +1,136 @@
+import os
+import logging
+
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+# Environment variables read by OpenMP, MKL, OpenBLAS and numexpr when the
+# libraries are loaded: they must be set before numpy/torch are imported
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+
+def available_cores() -> int:
+    """
+    Cores this process can use: CPU affinity, capped by the cgroup CPU quota
+    of the container if there is one.
+
+    Returns:
+    - int: The number of usable cores (at least 1).
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max", "r") as file:
+            quota, period = file.read().split()
+        if quota != "max":
+            cores = min(cores, max(1, int(int(quota) / int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cores)
+
+
+def thread_budget() -> Dict[str, int]:
+    """
+    Split the cores between the gunicorn workers (WEB_CONCURRENCY) and the
+    concurrent stages of each worker (VHR_EXECUTOR_WORKERS), so all of them
+    running at once use each core once. VHR_INTRA_OP_THREADS and
+    VHR_INTER_OP_THREADS override the computed values.
+
+    Returns:
+    - Dict[str, int]: cores, workers, executor_workers, intra_op and inter_op.
+    """
+    cores = available_cores()
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    executor_workers = max(1, int(os.getenv("VHR_EXECUTOR_WORKERS", "2")))
+
+    intra_op = int(os.getenv("VHR_INTRA_OP_THREADS", "0")) or max(1, cores // (workers * executor_workers))
+    inter_op = int(os.getenv("VHR_INTER_OP_THREADS", "1"))
+    return {
+        "cores": cores,
+        "workers": workers,
+        "executor_workers": executor_workers,
+        "intra_op": intra_op,
+        "inter_op": inter_op,
+    }
+
+
+def apply_env() -> Dict[str, int]:
+    """
+    Set the thread environment variables of the native libraries. Call it
+    before importing numpy or torch. Variables already set are respected.
+
+    Returns:
+    - Dict[str, int]: The budget (see thread_budget).
+    """
+    budget = thread_budget()
+    for name in THREAD_ENV_VARS:
+        os.environ.setdefault(name, str(budget["intra_op"]))
+    return budget
+
+
+def apply_runtime() -> Dict[str, int]:
+    """
+    Set the torch intra-op and inter-op threads and the OpenCV threads.
+    Call it at startup, before loading the models.
+
+    Returns:
+    - Dict[str, int]: The budget (see thread_budget).
+    """
+    import torch
+
+    budget = thread_budget()
+    torch.set_num_threads(budget["intra_op"])
+    try:
+        torch.set_num_interop_threads(budget["inter_op"])
+    except RuntimeError:
+        # The inter-op pool can only be sized before its first use
+        logger.warning(f"Inter-op threads already initialized, keeping {torch.get_num_interop_threads()}")
+
+    try:
+        import cv2
+        cv2.setNumThreads(budget["intra_op"])
+    except ImportError:
+        pass
+
+    logger.info(f"Thread budget of worker {os.getpid()}: {budget}")
+    return budget
+
+
+def diagnostics() -> Dict[str, Any]:
+    """
+    Effective thread settings of this process.
+
+    Returns:
+    - Dict[str, Any]: The budget, the torch settings and the environment.
+    """
+    import torch
+
+    info = {
+        "pid": os.getpid(),
+        "budget": thread_budget(),
+        "torch": {
+            "num_threads": torch.get_num_threads(),
+            "num_interop_threads": torch.get_num_interop_threads(),
+            "parallel_info": torch.__config__.parallel_info(),
+        },
+        "env": {name: os.getenv(name) for name in THREAD_ENV_VARS},
+    }
+    try:
+        from threadpoolctl import threadpool_info
+        info["threadpools"] = [
+            {k: pool.get(k) for k in ("user_api", "internal_api", "num_threads", "filepath")}
+            for pool in threadpool_info()
+        ]
+    except ImportError:
+        pass
+    return info
@@ -0,0 +1,307 @@
+import io
+import os
+import hashlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+
+import rasterio as rio
+from PIL import Image
+from rasterio.transform import Affine, from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import Resampling, calculate_default_transform, reproject, transform_bounds
+
+import jobs
+import artifact_store
+from raster_io import OUTPUT_DIR, list_products, product_paths, read_metadata, read_product
+from render import apply_stretch, folder_stretch
+
+TILE_SIZE = 256
+TILE_CACHE_MAX_BYTES = int(os.getenv("VHR_TILE_CACHE_MAX_BYTES", str(64 * 1024 ** 2)))
+TILE_MAX_AGE = int(os.getenv("VHR_TILE_MAX_AGE", "86400"))
+
+# Product of the URL -> prefix of the stored rasters
+PRODUCTS = {"s2": "image", "sr": "sr", "build": "build"}
+# Color (RGBA) of the buildings over the map
+BUILD_COLOR = (255, 48, 48, 200)
+
+# Half the side of the Web Mercator square, in meters
+MERCATOR_ORIGIN = 20037508.342789244
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Bounds (west, south, east, north) of an XYZ tile in EPSG:3857."""
+    size = 2 * MERCATOR_ORIGIN / 2 ** z
+    west = -MERCATOR_ORIGIN + x * size
+    north = MERCATOR_ORIGIN - y * size
+    return west, north - size, west + size, north
+
+
+class TileCache:
+    """
+    In-memory LRU cache of encoded tiles, bounded by their total size.
+    """
+
+    def __init__(self, max_bytes: int = TILE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._tiles: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                self.misses += 1
+                return None
+            self._tiles.move_to_end(key)
+            self.hits += 1
+            return tile
+
+    def put(self, key: str, tile: bytes) -> None:
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._bytes += len(tile)
+            while self._bytes > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "tiles": len(self._tiles),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+cache = TileCache()
+
+
+def resolve_folder(job: str) -> str:
+    """
+    Get the folder of a job: a job id of the queue, or the name of a folder
+    (job folder or AOI workspace) under OUTPUT_DIR.
+
+    Raises:
+    - LookupError: If there is no such job or folder.
+    """
+    if job and os.sep not in job and job not in (".", ".."):
+        folder = os.path.join(OUTPUT_DIR, job)
+        if os.path.isdir(folder):
+            artifact_store.get_store().touch(folder)
+            return folder
+
+    record = jobs.get_store().get(job)
+    if record is not None and record["result"] and "folder" in record["result"]:
+        artifact_store.get_store().touch(record["result"]["folder"])
+        return record["result"]["folder"]
+    raise LookupError(f"Job {job} not found")
+
+
+def _read_cog_tile(
+    path: str, bounds: Tuple[float, float, float, float], resampling: Resampling, bands: Optional[int] = None
+) -> np.ndarray:
+    # A WarpedVRT over the part of the tile the product covers, at the source
+    # resolution but at most twice the output size: the warp work is bounded
+    # by the tile, and the decimated read makes GDAL read the matching
+    # overview and only the internal blocks under the tile
+    with rio.open(path) as src:
+        count = min(bands or src.count, src.count)
+        data = np.full((count, TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+
+        # Pixels of the tile inside the product
+        src_west, src_south, src_east, src_north = transform_bounds(src.crs, "EPSG:3857", *src.bounds)
+        size = (bounds[2] - bounds[0]) / TILE_SIZE
+        col0 = max(0, int(np.floor((src_west - bounds[0]) / size)))
+        col1 = min(TILE_SIZE, int(np.ceil((src_east - bounds[0]) / size)))
+        row0 = max(0, int(np.floor((bounds[3] - src_north) / size)))
+        row1 = min(TILE_SIZE, int(np.ceil((bounds[3] - src_south) / size)))
+        if col1 <= col0 or row1 <= row0:
+            return data
+        window = (bounds[0] + col0 * size, bounds[3] - row1 * size, bounds[0] + col1 * size, bounds[3] - row0 * size)
+
+        native, _, _ = calculate_default_transform(src.crs, "EPSG:3857", src.width, src.height, *src.bounds)
+        width = max(1, min(round((window[2] - window[0]) / native.a), 2 * (col1 - col0)))
+        height = max(1, min(round((window[3] - window[1]) / -native.e), 2 * (row1 - row0)))
+        with WarpedVRT(
+            src,
+            crs="EPSG:3857",
+            transform=from_bounds(*window, width, height),
+            width=width,
+            height=height,
+            resampling=resampling,
+            add_alpha=True,
+        ) as vrt:
+            part = vrt.read(
+                indexes=list(range(1, count + 1)), out_shape=(count, row1 - row0, col1 - col0),
+                out_dtype="float32", resampling=resampling,
+            )
+            alpha = vrt.read(src.count + 1, out_shape=(row1 - row0, col1 - col0), resampling=Resampling.nearest)
+        scale = src.scales[0]
+    if scale != 1:
+        part *= np.float32(scale)
+    part[:, alpha == 0] = np.nan
+    data[:, row0:row1, col0:col1] = part
+    return data
+
+
+def _read_npy_tile(
+    path: str,
+    metadata: Dict[str, Any],
+    bounds: Tuple[float, float, float, float],
+    resampling: Resampling,
+    bands: Optional[int] = None,
+) -> np.ndarray:
+    # The .npy products are memory-mapped: only the rows and columns of the
+    # source window under the tile are read, decimated at low zoom levels
+    source = read_product(path, mmap=True)
+    if source.ndim == 2:
+        source = source[None]
+    source = source[:bands]
+    _, rows, cols = source.shape
+    src_crs = f"EPSG:{metadata['epsg']}"
+    src_transform = from_bounds(*metadata["bbox"], cols, rows)
+
+    west, south, east, north = transform_bounds("EPSG:3857", src_crs, *bounds)
+    col0, row0 = ~src_transform * (west, north)
+    col1, row1 = ~src_transform * (east, south)
+    # One pixel of margin for the resampling kernel
+    row0, col0 = max(0, int(np.floor(row0)) - 1), max(0, int(np.floor(col0)) - 1)
+    row1, col1 = min(rows, int(np.ceil(row1)) + 1), min(cols, int(np.ceil(col1)) + 1)
+
+    destination = np.full((source.shape[0], TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+    if row1 <= row0 or col1 <= col0:
+        return destination
+    step = max(1, min(row1 - row0, col1 - col0) // (2 * TILE_SIZE))
+    window = np.asarray(source[:, row0:row1:step, col0:col1:step], dtype=np.float32)
+    reproject(
+        window,
+        destination,
+        src_transform=src_transform * Affine.translation(col0, row0) * Affine.scale(step),
+        src_crs=src_crs,
+        dst_transform=from_bounds(*bounds, TILE_SIZE, TILE_SIZE),
+        dst_crs="EPSG:3857",
+        dst_nodata=np.nan,
+        resampling=resampling,
+    )
+    return destination
+
+
+def _encode(rgba: np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+@lru_cache(maxsize=1)
+def empty_tile() -> bytes:
+    return _encode(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+def _product_path(folder: str, product: str, date_eval: str) -> str:
+    if product not in PRODUCTS:
+        raise ValueError(f"Unknown product '{product}', use one of {list(PRODUCTS)}")
+    path = product_paths(folder, PRODUCTS[product]).get(date_eval)
+    if path is None:
+        raise FileNotFoundError(f"No {product} product for {date_eval} in {os.path.basename(folder)}")
+    return path
+
+
+def _tile_key(path: str, z: int, x: int, y: int) -> Tuple[str, str]:
+    # Key of the tile cache and ETag, from the mtime of the product
+    key = f"{path}|{os.path.getmtime(path)}|{z}/{x}/{y}"
+    return key, hashlib.sha256(key.encode()).hexdigest()[:20]
+
+
+def render_tile(folder: str, product: str, date_eval: str, z: int, x: int, y: int) -> Tuple[bytes, str]:
+    """
+    Render an XYZ tile (EPSG:3857) of a stored product, reading and
+    reprojecting only the part of the product under the tile: a windowed,
+    decimated read through a WarpedVRT (and the overviews) for COGs, a slice
+    of the memory-mapped array for .npy. The encoded tiles are cached in memory.
+
+    Args:
+    - folder (str): The job folder.
+    - product (str): "s2", "sr" or "build".
+    - date_eval (str): The date of the product.
+    - z, x, y (int): The tile.
+
+    Returns:
+    - bytes: The RGBA PNG.
+    - str: The ETag of the tile.
+
+    Raises:
+    - ValueError: If the product is unknown.
+    - FileNotFoundError: If the folder has no such product.
+    """
+    path = _product_path(folder, product, date_eval)
+    key, etag = _tile_key(path, z, x, y)
+    tile = cache.get(key)
+    if tile is not None:
+        return tile, etag
+
+    metadata = read_metadata(folder)
+    if "epsg" not in metadata:
+        raise FileNotFoundError(f"The folder {os.path.basename(folder)} has no georeference")
+    src_crs = f"EPSG:{metadata['epsg']}"
+    bounds = tile_bounds(z, x, y)
+    west, south, east, north = transform_bounds(src_crs, "EPSG:3857", *metadata["bbox"])
+
+    if east <= bounds[0] or west >= bounds[2] or north <= bounds[1] or south >= bounds[3]:
+        tile = empty_tile()
+    else:
+        resampling = Resampling.nearest if product == "build" else Resampling.bilinear
+        # The RGB bands only
+        bands = None if product == "build" else 3
+        if path.endswith(".npy"):
+            destination = _read_npy_tile(path, metadata, bounds, resampling, bands)
+        else:
+            destination = _read_cog_tile(path, bounds, resampling, bands)
+        valid = ~np.isnan(destination[0])
+        np.nan_to_num(destination, copy=False, nan=0.0)
+
+        rgba = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+        if product == "build":
+            rgba[valid & (destination[0] > 0.5)] = BUILD_COLOR
+        else:
+            stretch = folder_stretch(folder, lambda: [read_product(p) for p in list_products(folder, "image")])
+            rgba[..., :3] = apply_stretch(destination, stretch, scale=1e-4 if product == "s2" else 1.0)
+            rgba[..., 3] = np.where(valid, 255, 0)
+        tile = _encode(rgba)
+
+    cache.put(key, tile)
+    return tile, etag
+
+
+def serve_tile(
+    job: str, product: str, date_eval: str, z: int, x: int, y: int, if_none_match: Optional[str] = None
+) -> Tuple[Optional[bytes], str]:
+    """
+    Get a tile of a job for a request: resolve the folder, then render the
+    tile unless the client already has it (its ETag, from the mtime of the
+    product, matches if_none_match).
+
+    Returns:
+    - bytes: The RGBA PNG, or None if the client has it.
+    - str: The ETag of the tile.
+
+    Raises:
+    - LookupError: If there is no such job or folder.
+    - ValueError: If the product is unknown.
+    - FileNotFoundError: If the folder has no such product.
+    """
+    folder = resolve_folder(job)
+    _, etag = _tile_key(_product_path(folder, product, date_eval), z, x, y)
+    if if_none_match == f'"{etag}"':
+        return None, etag
+    return render_tile(folder, product, date_eval, z, x, y)
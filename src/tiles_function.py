@@ -0,0 +1,51 @@
+import asyncio
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+import tiles
+import logging
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# XYZ TILE OF A PRODUCT
+@router.get("/{job}/{product}/{date}/{z}/{x}/{y}.png")
+async def get_tile(job: str, product: str, date: str, z: int, x: int, y: int, request: Request):
+    """
+    Render on demand a 256 px Web Mercator tile of a stored product, to
+    overlay the results on a web map (XYZ source) at any zoom.
+
+    Args:
+    - job (str): The job id, or the name of the job folder or AOI workspace.
+    - product (str): "s2", "sr" or "build" (buildings in color, the rest transparent).
+    - date (str): The date of the product.
+    - z, x, y (int): The tile.
+
+    return:
+    - The RGBA PNG, with ETag and Cache-Control headers.
+    """
+    try:
+        tile, etag = await asyncio.to_thread(
+            tiles.serve_tile, job, product, date, z, x, y, request.headers.get("if-none-match")
+        )
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error in get_tile: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"public, max-age={tiles.TILE_MAX_AGE}"}
+    if tile is None:
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile, media_type="image/png", headers=headers)
+
+# TILE CACHE STATS
+@router.get("/cache")
+async def tile_cache_stats():
+    """
+    Get the usage and hit/miss counters of the in-memory tile cache.
+    """
+    return tiles.cache.stats()
@@ -0,0 +1,114 @@
+import numpy as np
+
+from typing import Callable, List
+
+
+def tile_starts(size: int, tile: int, overlap: int) -> List[int]:
+    """
+    Start offsets of the tiles covering [0, size) with at least `overlap`
+    pixels shared between neighbours. The last tile is aligned to the end.
+
+    Args:
+    - size (int): The size of the axis.
+    - tile (int): The tile size.
+    - overlap (int): The minimum overlap between tiles.
+
+    Returns:
+    - List[int]: The start offsets.
+
+    Raises:
+    - ValueError: If the axis needs several tiles and the overlap is negative
+      or not smaller than the tile.
+    """
+    if tile >= size:
+        return [0]
+    if overlap < 0 or overlap >= tile:
+        raise ValueError(f"The tile overlap ({overlap}) must be in [0, tile size ({tile}))")
+    stride = tile - overlap
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
+
+
+def blend_window(height: int, width: int, overlap: int, mode: str = "feather") -> np.ndarray:
+    """
+    Weights used to blend overlapping tiles.
+
+    Args:
+    - height (int): The tile height.
+    - width (int): The tile width.
+    - overlap (int): The overlap between tiles.
+    - mode (str): "feather" (linear ramps over the overlap) or "gaussian".
+
+    Returns:
+    - np.ndarray: The (height, width) float32 weights, all greater than 0.
+    """
+    def axis(n):
+        if mode == "gaussian":
+            x = np.arange(n, dtype=np.float32) - (n - 1) / 2
+            return np.maximum(np.exp(-(x ** 2) / (2 * (n / 4) ** 2)), 1e-3)
+        if mode != "feather":
+            raise ValueError(f"Unknown blend mode '{mode}', use 'feather' or 'gaussian'")
+        w = np.ones(n, dtype=np.float32)
+        ramp_size = min(overlap, n // 2)
+        if ramp_size > 0:
+            ramp = np.arange(1, ramp_size + 1, dtype=np.float32) / (ramp_size + 1)
+            w[:ramp_size] = ramp
+            w[-ramp_size:] = ramp[::-1]
+        return w
+
+    return np.outer(axis(height), axis(width)).astype(np.float32)
+
+
+def tiled_apply(
+    func: Callable[[np.ndarray], np.ndarray],
+    image: np.ndarray,
+    tile: int,
+    overlap: int,
+    out_channels: int,
+    scale: int = 1,
+    batch_size: int = 1,
+    mode: str = "feather",
+) -> np.ndarray:
+    """
+    Apply a model to overlapping tiles of an image and blend the outputs, so
+    the peak memory depends on the tile size and not on the image size.
+
+    Args:
+    - func (Callable): Maps a (n, C, tile, tile) float32 batch to a
+      (n, out_channels, tile * scale, tile * scale) array.
+    - image (np.ndarray): The (C, H, W) input.
+    - tile (int): The tile size, in input pixels.
+    - overlap (int): The overlap between tiles, in input pixels.
+    - out_channels (int): The channels of the output.
+    - scale (int): The upscaling factor of func.
+    - batch_size (int): The tiles per call to func.
+    - mode (str): The blend window (see blend_window).
+
+    Returns:
+    - np.ndarray: The (out_channels, H * scale, W * scale) float32 blended output.
+
+    Raises:
+    - ValueError: If the overlap is negative or not smaller than the tile.
+    """
+    if overlap < 0 or overlap >= tile:
+        raise ValueError(f"The tile overlap ({overlap}) must be in [0, tile size ({tile}))")
+    _, height, width = image.shape
+    tile_h, tile_w = min(tile, height), min(tile, width)
+    window = blend_window(tile_h * scale, tile_w * scale, overlap * scale, mode)
+
+    output = np.zeros((out_channels, height * scale, width * scale), dtype=np.float32)
+    weights = np.zeros((height * scale, width * scale), dtype=np.float32)
+
+    offsets = [(y, x) for y in tile_starts(height, tile_h, overlap) for x in tile_starts(width, tile_w, overlap)]
+    for start in range(0, len(offsets), batch_size):
+        chunk = offsets[start:start + batch_size]
+        batch = np.stack([image[:, y:y + tile_h, x:x + tile_w] for y, x in chunk]).astype(np.float32, copy=False)
+        predictions = func(batch)
+        for (y, x), prediction in zip(chunk, predictions):
+            ys, xs = slice(y * scale, (y + tile_h) * scale), slice(x * scale, (x + tile_w) * scale)
+            output[:, ys, xs] += prediction * window
+            weights[ys, xs] += window
+
+    output /= weights
+    return output
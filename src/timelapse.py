@@ -0,0 +1,200 @@
+import os
+import tempfile
+import threading
+import subprocess
+import numpy as np
+
+from typing import Dict, Iterator, List, Optional
+
+from PIL import Image
+
+import artifact_store
+from raster_io import list_products, product_paths, read_product
+from render import apply_stretch, composite, folder_stretch, mask_to_gray
+
+FFMPEG = os.getenv("VHR_FFMPEG", "ffmpeg")
+TIMELAPSE_MAX_SIZE = int(os.getenv("VHR_TIMELAPSE_MAX_SIZE", "1024"))
+CHUNK_SIZE = 64 * 1024
+
+PRODUCTS = ("s2", "sr", "build", "combined")
+FORMATS = {"mp4": "video/mp4", "webp": "image/webp"}
+
+
+def timelapse_dates(folder: str, product: str, dates: Optional[List[str]] = None) -> List[str]:
+    """
+    Check a time-lapse request and get the dates with all the products it needs.
+
+    Raises:
+    - ValueError: If the product is unknown.
+    - FileNotFoundError: If no date has the products.
+    """
+    if product not in PRODUCTS:
+        raise ValueError(f"Unknown product '{product}', use one of {list(PRODUCTS)}")
+    prefixes = {"s2": ["image"], "sr": ["image", "sr"], "build": ["build"], "combined": ["image", "sr", "build"]}
+    available = None
+    for prefix in prefixes[product]:
+        found = set(product_paths(folder, prefix))
+        available = found if available is None else available & found
+    if dates:
+        available &= set(dates)
+    if not available:
+        raise FileNotFoundError(f"No {product} products in {os.path.basename(folder)}")
+    return sorted(available)
+
+
+def _path(folder: str, prefix: str, date_eval: str) -> str:
+    return product_paths(folder, prefix)[date_eval]
+
+
+def render_frame(folder: str, product: str, date_eval: str, stretch: Dict) -> np.ndarray:
+    """Render the (H, W, 3) uint8 frame of one date."""
+    if product == "s2":
+        return apply_stretch(read_product(_path(folder, "image", date_eval)), stretch, scale=1e-4)
+    if product == "sr":
+        return apply_stretch(read_product(_path(folder, "sr", date_eval)), stretch)
+    build = mask_to_gray(read_product(_path(folder, "build", date_eval)))
+    if product == "build":
+        return np.repeat(build[..., None], 3, axis=2)
+    return composite([
+        apply_stretch(read_product(_path(folder, "image", date_eval)), stretch, scale=1e-4),
+        apply_stretch(read_product(_path(folder, "sr", date_eval)), stretch),
+        build,
+    ])
+
+
+def frame_size(height: int, width: int, max_size: int) -> tuple:
+    """Size (width, height) of the frames: at most max_size per side, even for yuv420p."""
+    ratio = min(1.0, max_size / max(height, width))
+    return max(2, int(width * ratio) // 2 * 2), max(2, int(height * ratio) // 2 * 2)
+
+
+def iter_frames(folder: str, product: str, dates: List[str], max_size: int) -> Iterator[np.ndarray]:
+    """
+    Render the frames one at a time, all with the size of the first one.
+    The folder stretch is shared, so the colors are stable across dates.
+    """
+    stretch = folder_stretch(folder, lambda: [read_product(p) for p in list_products(folder, "image")])
+    resample = Image.NEAREST if product == "build" else Image.BILINEAR
+    size = None
+    for date_eval in dates:
+        frame = render_frame(folder, product, date_eval, stretch)
+        if size is None:
+            size = frame_size(*frame.shape[:2], max_size)
+        if frame.shape[1::-1] != size:
+            frame = np.asarray(Image.fromarray(frame).resize(size, resample))
+        yield np.ascontiguousarray(frame)
+
+
+def ffmpeg_command(output_format: str, width: int, height: int, fps: float, output: str) -> List[str]:
+    command = [
+        FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:0",
+    ]
+    if output_format == "mp4":
+        # Fragmented MP4 can be written to a pipe and played while it arrives
+        return command + [
+            "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+            "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", output,
+        ]
+    return command + ["-c:v", "libwebp", "-lossless", "0", "-quality", "85", "-loop", "0", "-f", "webp", output]
+
+
+def _feed(process: subprocess.Popen, frames: Iterator[np.ndarray], errors: List[Exception]) -> None:
+    try:
+        for frame in frames:
+            process.stdin.write(frame.tobytes())
+    except (BrokenPipeError, ValueError):
+        # ffmpeg exited (or the client went away and the process was killed)
+        pass
+    except Exception as e:
+        # A frame failed: ffmpeg is killed so it does not finish a truncated
+        # video, and the error is raised by the reader
+        errors.append(e)
+        process.kill()
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def stream_timelapse(
+    folder: str,
+    product: str = "sr",
+    output_format: str = "mp4",
+    fps: float = 2.0,
+    max_size: int = TIMELAPSE_MAX_SIZE,
+    dates: Optional[List[str]] = None,
+) -> Iterator[bytes]:
+    """
+    Encode the time-lapse of a folder with ffmpeg, yielding the encoded bytes.
+
+    The frames are rendered and piped to ffmpeg one at a time by a thread,
+    so only one frame is in memory. MP4 (fragmented) is streamed from the
+    ffmpeg output as it is encoded; the WebP muxer needs to seek back at the
+    end, so the animated WebP is encoded to a temporary file and streamed
+    from it.
+
+    Args:
+    - folder (str): The job folder.
+    - product (str): "s2", "sr", "build" or "combined".
+    - output_format (str): "mp4" or "webp".
+    - fps (float): Frames (dates) per second.
+    - max_size (int): Maximum side of the frames, in pixels.
+    - dates (List[str], optional): Only these dates. All by default.
+
+    Returns:
+    - Iterator[bytes]: The chunks of the encoded file.
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown format '{output_format}', use one of {list(FORMATS)}")
+    dates = timelapse_dates(folder, product, dates)
+    frames = iter_frames(folder, product, dates, min(max_size, TIMELAPSE_MAX_SIZE))
+    with artifact_store.get_store().hold(folder):
+        yield from _encode(frames, next(frames), output_format, fps)
+
+
+def _encode(frames: Iterator[np.ndarray], first: np.ndarray, output_format: str, fps: float) -> Iterator[bytes]:
+    height, width = first.shape[:2]
+
+    def all_frames():
+        yield first
+        yield from frames
+
+    tmp_path = None
+    if output_format == "mp4":
+        output = "pipe:1"
+    else:
+        handle, tmp_path = tempfile.mkstemp(suffix=".webp")
+        os.close(handle)
+        output = tmp_path
+
+    process = subprocess.Popen(
+        ffmpeg_command(output_format, width, height, fps, output),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE if output_format == "mp4" else subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    errors = []
+    writer = threading.Thread(target=_feed, args=(process, all_frames(), errors), daemon=True)
+    writer.start()
+    try:
+        if output_format == "mp4":
+            for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b""):
+                yield chunk
+        writer.join()
+        if errors:
+            raise errors[0]
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed: {process.stderr.read().decode(errors='replace')}")
+        if tmp_path is not None:
+            with open(tmp_path, "rb") as file:
+                for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                    yield chunk
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        writer.join()
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -5,7 +5,7 @@ import planet
 import pyproj
 import rasterio as rio
 
-from typing import Dict, List
+from typing import AsyncIterator, Dict, List
 from basemodels import SFilterDict, ItemDict, OrderDict
 
 
@@ -49,18 +49,48 @@ def create_geometry(point: List[float], edge_size:int, resolution: int=3) -> str
     return geo_square
 
 
-# Get and store credentials in an Auth object
+# Get the credentials in an Auth object
 def get_auth(api_key: str) -> planet.Auth:
     """
-    Get the user account from the API key, and store credentials in an Auth object.
+    Get the credentials of an API key in an Auth object. They are only kept
+    in memory (see planet_sessions), never stored in ~/.planet.json.
     """
+    return planet.Auth.from_key(api_key)
 
-    # Store the credentials in an Auth object
-    auth = planet.Auth.from_key(api_key)
-    auth.store()
 
-    print("Credentials stored in Auth object.")
-    return auth
+def parse_geometry(geometry: str, edge_size: int) -> List[List[float]]:
+    """
+    Get the ring of the area of interest from the geometry sent by the client.
+
+    Args:
+    - geometry (str): The JSON of a point [lon, lat] or of a polygon ring
+      [[lon, lat], ...], in EPSG:4326.
+    - edge_size (int): The size of the square edge around a point.
+
+    Returns:
+    - List[List[float]]: The closed polygon ring in EPSG:4326.
+
+    Raises:
+    - ValueError: If the geometry is not a point or a ring.
+    """
+    try:
+        coordinates = json.loads(geometry)
+    except (TypeError, json.JSONDecodeError):
+        raise ValueError("The geometry must be the JSON of a point or a polygon ring")
+
+    if isinstance(coordinates, list) and len(coordinates) == 2 and all(isinstance(c, (int, float)) for c in coordinates):
+        # create_geometry buffers in Web Mercator meters
+        transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
+        return create_geometry(list(transformer.transform(*coordinates)), edge_size)
+
+    if not isinstance(coordinates, list) or len(coordinates) < 3 or not all(
+        isinstance(c, list) and len(c) >= 2 for c in coordinates
+    ):
+        raise ValueError("The geometry must be the JSON of a point or a polygon ring")
+    ring = [list(c[:2]) for c in coordinates]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return ring
 
 
 # Create filters for the Planet API request
@@ -75,7 +105,7 @@ def create_filters(
     Create filters for the Planet API request.
 
     Args:
-    - geometry (str): The geometry in string format.
+    - geometry (str): The geometry in string format (see parse_geometry).
     - edge_size (int): The size of the square edge.
     - date_range (Tuple[str, str]): The date range.
     - cloud_cover (float): The cloud cover percentage to filter if less
@@ -84,8 +114,8 @@ def create_filters(
     Returns:
     - SFilterDict: The filters for the Planet API request.
     """
-    # Get geometries from a point
-    geometry = create_geometry(geometry, edge_size)
+    # Get the ring of the area of interest
+    geometry = parse_geometry(geometry, edge_size)
 
     # For geometry
     geometry_filter = {
@@ -125,41 +155,43 @@ def create_filters(
 
 
 async def query_data(
-    auth: planet.Auth,
+    session: planet.Session,
     item_type: str,
     sfilter: SFilterDict,
     asset: str = "ortho_analytic_4b_sr",
-) -> Dict[str,ItemDict]:
+    page_size: int = 50,
+    limit: int = 100,
+) -> AsyncIterator[Dict[str, ItemDict]]:
     """
-    Query the Planet API for data items id and thumbnails that match 
-    the filters.
+    Query the Planet API for data items id and thumbnails that match
+    the filters, in pages yielded as the results arrive.
 
     Args:
-    - auth (planet.Auth): The user account credentials.
+    - session (planet.Session): The open session of the user.
     - item_type (str): The item type.
     - sfilter (SFilterDict): The filters for the API request.
     - asset (str): The asset to download.
+    - page_size (int): Items per page.
+    - limit (int): Maximum number of items searched (0 for no limit).
 
     Returns:
-    - List[ItemDict]: The list of items dictionaries that match the filters.
+    - AsyncIterator[Dict[str, ItemDict]]: Pages of the items that match the
+      filters and have the asset, numbered Item_1, Item_2... across pages.
     """
+    client = session.client("data")
 
-    # Open a session client for data with the API
-    async with planet.Session(auth=auth) as sess:
-        client = sess.client("data")
-
-        try:
-            counter = 1
-            items_dicts = {}
-            async for query in client.search([item_type], sfilter):
-                if asset in query["assets"]:
-                    items_dicts[f"Item_{counter}"] = query
-                    counter += 1
+    counter = 1
+    page = {}
+    async for query in client.search([item_type], sfilter, limit=limit):
+        if asset in query["assets"]:
+            page[f"Item_{counter}"] = query
+            counter += 1
+            if len(page) == page_size:
+                yield page
+                page = {}
 
-            return items_dicts
-
-        except Exception as e:
-            print(f"An error occurred: {e}")
+    if page:
+        yield page
 
 
 # Create a request
@@ -169,6 +201,7 @@ def create_request(
     geometry: str,
     edge_size: int,
     product_bundle: str = "analytic_sr_udm2",
+    name: str = None,
 ) -> OrderDict:
     """
     Create an order request for the Planet API.
@@ -179,14 +212,17 @@ def create_request(
     - geometry (str): The geometry in string format.
     - edge_size (int): The size of the square edge.
     - product_bundle (str): The product bundle to order.
+    - name (str): The name of the order. By default from the item type and
+      the first item.
 
     Returns:
     - OrderDict: The order request.
     """
-    # Get geometries from a point
-    geometry = create_geometry(geometry, edge_size)
+    # Get the ring of the area of interest
+    geometry = parse_geometry(geometry, edge_size)
     # Create order request
     order = planet.order_request.build_request(
+        name=name or f"{item_type}_{item_list[0]}_{len(item_list)}",
         products=[
             planet.order_request.product(
                 item_ids=item_list,
@@ -196,7 +232,7 @@ def create_request(
         ],
         tools=[
             planet.order_request.clip_tool(aoi={"type": "Polygon", 
-                                                "coordinates": [json.loads(geometry)]}),            
+                                                "coordinates": [geometry]}),            
             planet.order_request.composite_tool(),
             planet.order_request.harmonize_tool("Sentinel-2")
         ],
@@ -220,6 +256,8 @@ async def create_and_download(
     - directory (str): The directory to save the downloaded files.
     """
 
+    pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+
     # Check the order status
     with planet.reporting.StateBar(state="creating") as bar:
         detail = await client.create_order(order_detail)